@@ -288,6 +288,8 @@ listling.ListPage = class extends micro.Page {
         updateClass();
 
         this._items = null;
+        this._revision = null;
+        this._eventSource = null;
         this._form = this.querySelector("form");
         this._events = ["list-items-create", "list-items-move", "item-edit", "item-trash",
                         "item-restore", "item-check", "item-uncheck"];
@@ -298,19 +300,26 @@ listling.ListPage = class extends micro.Page {
         ui.shortcutContext.add("G", this._data.toggleTrash);
         ui.shortcutContext.add("C", this._data.toggleSettings);
         this._events.forEach(e => ui.addEventListener(e, this));
+        document.addEventListener("visibilitychange", this);
 
         this.ready.when((async() => {
             if (this._data.editMode) {
                 this._form.elements[0].focus();
             } else {
                 try {
-                    const items = await ui.call("GET", `/api/lists/${this._data.lst.id}/items`);
-                    this._items = new micro.bind.Watchable(items);
+                    this._revision = this._data.lst.revision;
+                    this._items = new micro.bind.Watchable(await this._getItems());
                 } catch (e) {
                     ui.handleCallError(e);
                     return;
                 }
 
+                // Catch up whenever someone else modifies the list
+                this._eventSource = new EventSource(
+                    `/api/lists/${this._data.lst.id}/activity/stream`
+                );
+                this._eventSource.addEventListener("message", this);
+
                 this._data.presentItems = micro.bind.filter(this._items, i => !i.trashed);
                 this._data.trashedItems = micro.bind.filter(this._items, i => i.trashed);
                 this._data.trashedItemsCount = this._data.trashedItems.length;
@@ -347,6 +356,11 @@ listling.ListPage = class extends micro.Page {
         ui.shortcutContext.remove("G");
         ui.shortcutContext.remove("C");
         this._events.forEach(e => ui.removeEventListener(e, this));
+        document.removeEventListener("visibilitychange", this);
+        if (this._eventSource) {
+            this._eventSource.close();
+            this._eventSource = null;
+        }
         this._data.presentation.exit().catch(micro.util.catch);
         if (this._data.playlist) {
             this._data.playlist.dispose();
@@ -391,9 +405,60 @@ listling.ListPage = class extends micro.Page {
             let i = this._items.findIndex(item => item.id === event.detail.item.id);
             this._items[i] = event.detail.item;
             this._data.trashedItemsCount = this._data.trashedItems.length;
+        } else if (event.type === "message") {
+            this._sync().catch(micro.util.catch);
+        } else if (event.type === "visibilitychange") {
+            if (document.visibilityState === "visible" && this._items) {
+                this._sync().catch(micro.util.catch);
+            }
         }
     }
 
+    async _sync() {
+        // Catch up with the changes made while the page was hidden
+        let result;
+        try {
+            result = await ui.call(
+                "GET", `/api/lists/${this._data.lst.id}/changes?since=${this._revision}`
+            );
+        } catch (e) {
+            if (e instanceof micro.APIError && e.error.code === "since_expired") {
+                // Get the revision first, so that no change is missed
+                const lst = await ui.call("GET", `/api/lists/${this._data.lst.id}`);
+                const items = await this._getItems();
+                this._revision = lst.revision;
+                this._items.splice(0, this._items.length, ...items);
+                this._data.trashedItemsCount = this._data.trashedItems.length;
+            } else {
+                ui.handleCallError(e);
+            }
+            return;
+        }
+
+        for (let change of result.changes) {
+            const i = this._items.findIndex(item => item.id === change.id);
+            if (i !== -1) {
+                this._items.splice(i, 1);
+            }
+            if (change.item) {
+                const j = change.after_id
+                    ? this._items.findIndex(item => item.id === change.after_id) + 1 : 0;
+                this._items.splice(j, 0, change.item);
+            }
+        }
+        this._revision = result.revision;
+        this._data.trashedItemsCount = this._data.trashedItems.length;
+    }
+
+    async _getItems() {
+        // Present and trashed items are retrieved separately
+        const [items, trashedItems] = await Promise.all([
+            ui.call("GET", `/api/lists/${this._data.lst.id}/items`),
+            ui.call("GET", `/api/lists/${this._data.lst.id}/items?trashed=true`)
+        ]);
+        return items.concat(trashedItems);
+    }
+
     async _moveItem(item, to) {
         ui.dispatchEvent(new CustomEvent("list-items-move", {detail: {item, to}}));
         try {
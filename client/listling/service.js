@@ -63,6 +63,15 @@ listling.service.Service = class extends micro.service.Service {
                     url: listling.util.makeListURL(event.object)
                 };
             },
+            "list-items-batch"(event) {
+                const count = event.detail.ops.length;
+                const items = count === 1 ? "item" : "items";
+                return {
+                    title: event.object.title,
+                    body: `${micro.util.truncate(event.user.name)} modified ${count} ${items}`,
+                    url: listling.util.makeListURL(event.object)
+                };
+            },
             "editable-edit+Item": event => renderItemNotification(event, '{user} edited "{item}"'),
             "trashable-trash+Item":
                 event => renderItemNotification(event, '{user} trashed "{item}"'),
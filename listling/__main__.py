@@ -14,6 +14,7 @@
 
 """Open Listling script."""
 
+from datetime import timedelta
 import sys
 
 from micro.util import make_command_line_parser, setup_logging
@@ -22,12 +23,51 @@ from .server import make_server
 
 def main(args):
     """Run Open Listling with the given list of command line *args*."""
-    args = make_command_line_parser().parse_args(args[1:])
+    parser = make_command_line_parser()
+    parser.add_argument(
+        '--workers', type=int,
+        help='Number of server processes, sharing the port. Defaults to 1.')
+    parser.add_argument(
+        '--slow-request-threshold', type=float,
+        help='Log requests which take at least the given number of seconds, with a breakdown.')
+    parser.add_argument(
+        '--trash-retention', type=float,
+        help='Number of days after which trashed items are permanently deleted. Defaults to 7.')
+    parser.add_argument(
+        '--activity-max-events', type=int,
+        help='Maximum number of events retained per activity, 0 meaning no limit. Defaults to '
+             '10000.')
+    parser.add_argument(
+        '--activity-max-age', type=float,
+        help='Number of days after which events are discarded from activities. Defaults to no '
+             'limit.')
+    parser.add_argument(
+        '--repair-summaries', action='store_true',
+        help='Rebuild the list summaries from the items and exit.')
+    parser.add_argument(
+        '--compact-activities', action='store_true',
+        help='Discard the events of all activities which exceed the retention policy and exit.')
+    args = parser.parse_args(args[1:])
+    repair_summaries = vars(args).pop('repair_summaries', False)
+    compact_activities = vars(args).pop('compact_activities', False)
     if 'video_service_keys' in args:
         values = iter(args.video_service_keys)
         args.video_service_keys = dict(zip(values, values))
+    if 'trash_retention' in args:
+        args.trash_retention = timedelta(days=args.trash_retention)
+    if 'activity_max_age' in args:
+        args.activity_max_age = timedelta(days=args.activity_max_age)
     setup_logging(getattr(args, 'debug', False))
-    make_server(**vars(args)).run()
+    server = make_server(**vars(args))
+    if repair_summaries:
+        server.app.update()
+        server.app.repair_summaries()
+        return 0
+    if compact_activities:
+        server.app.update()
+        server.app.compact_activities()
+        return 0
+    server.run()
     return 0
 
 if __name__ == '__main__':
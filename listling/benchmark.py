@@ -0,0 +1,228 @@
+# Open Listling
+# Copyright (C) 2018 Open Listling contributors
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of the GNU
+# Affero General Public License as published by the Free Software Foundation, either version 3 of
+# the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along with this program.
+# If not, see <https://www.gnu.org/licenses/>.
+
+"""Open Listling benchmark.
+
+A database is seeded with a realistic dataset, i.e. many users with some lists each and lists of
+various sizes. Then the web API of the server is driven by concurrent clients, measuring the
+latency and throughput per endpoint. To run the benchmark against the Redis database 15, type::
+
+    python3 -m listling.benchmark --redis-url 15 --output results.json
+
+Note that the database is flushed. Results of different versions can be compared with
+``--compare``.
+"""
+
+from argparse import ArgumentParser
+from asyncio import gather, get_event_loop
+from datetime import datetime
+import json
+from math import ceil
+import sys
+from time import perf_counter
+from urllib.parse import urljoin
+
+from micro.util import randstr
+from tornado.httpclient import AsyncHTTPClient
+
+from .server import make_server
+
+_BATCH_SIZE = 1000
+
+class Benchmark:
+    """Benchmark of the Open Listling web API.
+
+    .. attribute:: server
+
+       :class:`listling.server.Server` under test.
+
+    .. attribute:: users
+
+       Number of users to seed, each with a few lists.
+
+    .. attribute:: sizes
+
+       Sizes of the big lists to seed, i.e. their number of items.
+
+    .. attribute:: requests
+
+       Number of requests per endpoint.
+
+    .. attribute:: concurrency
+
+       Number of concurrent clients.
+    """
+
+    def __init__(self, server, *, users=100, sizes=(10, 1000, 50000), requests=1000,
+                 concurrency=10):
+        self.server = server
+        self.users = users
+        self.sizes = sizes
+        self.requests = requests
+        self.concurrency = concurrency
+        self._user = None
+        self._lists = {}
+
+    async def seed(self):
+        """Flush the database and seed it with the dataset."""
+        app = self.server.app
+        app.r.flushdb()
+        app.update()
+        for _ in range(self.users):
+            app.login()
+            for _ in range(3):
+                lst = app.lists.create('todo', v=2)
+                await lst.items.batch([{'op': 'create', 'title': 'Task {}'.format(i)}
+                                       for i in range(10)])
+
+        self._user = app.login()
+        for size in self.sizes:
+            lst = app.lists.create('todo', v=2)
+            lst.edit(title='List of {} items'.format(size))
+            for start in range(0, size, _BATCH_SIZE):
+                await lst.items.batch([
+                    {'op': 'create', 'title': 'Item {}'.format(i), 'text': randstr(),
+                     'checked': i % 2 == 0}
+                    for i in range(start, min(start + _BATCH_SIZE, size))])
+            self._lists[size] = lst
+
+    def scenarios(self):
+        """Return the requests to measure, as a list of ``(name, method, path, body)``."""
+        user_id = self._user.id
+        scenarios = [
+            ('GET /api/users/(id)/lists', 'GET', '/api/users/{}/lists'.format(user_id), None),
+            ('GET /api/users/(id)/lists?cursor', 'GET',
+             '/api/users/{}/lists?cursor=&limit=100'.format(user_id), None)
+        ]
+        for size, lst in self._lists.items():
+            item = lst.items[0]
+            scenarios += [
+                ('GET /api/lists/(id) [{}]'.format(size), 'GET', '/api/lists/{}'.format(lst.id),
+                 None),
+                ('GET /api/lists/(id)/items [{}]'.format(size), 'GET',
+                 '/api/lists/{}/items'.format(lst.id), None),
+                ('GET /api/lists/(id)/items?slice [{}]'.format(size), 'GET',
+                 '/api/lists/{}/items?slice=:100'.format(lst.id), None),
+                ('GET /api/lists/(id)/items/search [{}]'.format(size), 'GET',
+                 '/api/lists/{}/items/search?q=item'.format(lst.id), None),
+                ('POST /api/lists/(id)/items [{}]'.format(size), 'POST',
+                 '/api/lists/{}/items'.format(lst.id), '{"title": "Sleep"}'),
+                ('POST /api/lists/(id)/items/(item-id)/check [{}]'.format(size), 'POST',
+                 '/api/lists/{}/items/{}/check'.format(lst.id, item.id), '')
+            ]
+        return scenarios
+
+    async def run(self):
+        """Seed the database and measure all scenarios.
+
+        The results are returned as object ``{name: {"requests", "rps", "p50", "p99"}}``, with
+        latencies in milliseconds.
+        """
+        await self.seed()
+        client = AsyncHTTPClient(max_clients=self.concurrency)
+        results = {}
+        for name, method, path, body in self.scenarios():
+            results[name] = await self._measure(client, method, path, body)
+        return results
+
+    async def _measure(self, client, method, path, body):
+        url = urljoin(self.server.url, path)
+        headers = {'Cookie': 'auth_secret={}'.format(self._user.auth_secret)}
+        latencies = []
+        async def _client(count):
+            for _ in range(count):
+                t = perf_counter()
+                await client.fetch(url, method=method, body=body, headers=headers,
+                                   request_timeout=600)
+                latencies.append(perf_counter() - t)
+
+        t = perf_counter()
+        count = ceil(self.requests / self.concurrency)
+        await gather(*(_client(count) for _ in range(self.concurrency)))
+        duration = perf_counter() - t
+        latencies.sort()
+        return {
+            'requests': len(latencies),
+            'rps': len(latencies) / duration,
+            'p50': _percentile(latencies, 0.5) * 1000,
+            'p99': _percentile(latencies, 0.99) * 1000
+        }
+
+def compare(results, baseline):
+    """Compare the benchmark *results* to the ones of a *baseline*.
+
+    The relative change of throughput and latency is returned as object ``{name: {"rps", "p50",
+    "p99"}}`` for every scenario present in both.
+    """
+    return {
+        name: {key: result[key] / baseline[name][key] - 1 for key in ('rps', 'p50', 'p99')}
+        for name, result in results.items() if name in baseline
+    }
+
+def _percentile(values, p):
+    # Nearest-rank percentile of the sorted values
+    return values[max(ceil(p * len(values)) - 1, 0)]
+
+def main(args):
+    """Run the benchmark with the given list of command line *args*."""
+    parser = ArgumentParser(description='Benchmark the Open Listling web API.')
+    parser.add_argument('--redis-url', default='15',
+                        help='URL of the Redis database to use. It is flushed. Defaults to 15.')
+    parser.add_argument('--port', type=int, default=16161,
+                        help='Port of the server under test. Defaults to 16161.')
+    parser.add_argument('--users', type=int, default=100,
+                        help='Number of users to seed. Defaults to 100.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 1000, 50000],
+                        help='Sizes of the lists to seed. Defaults to 10 1000 50000.')
+    parser.add_argument('--requests', type=int, default=1000,
+                        help='Number of requests per endpoint. Defaults to 1000.')
+    parser.add_argument('--concurrency', type=int, default=10,
+                        help='Number of concurrent clients. Defaults to 10.')
+    parser.add_argument('--output', help='File to save the results to.')
+    parser.add_argument('--compare', help='File of earlier results to compare to.')
+    args = parser.parse_args(args[1:])
+
+    server = make_server(port=args.port, redis_url=args.redis_url)
+    benchmark = Benchmark(server, users=args.users, sizes=args.sizes, requests=args.requests,
+                          concurrency=args.concurrency)
+    async def _run():
+        server.start()
+        try:
+            return await benchmark.run()
+        finally:
+            await server.stop()
+    results = get_event_loop().run_until_complete(_run())
+    for name, result in results.items():
+        print('{:<60} {:>8.1f} req/s  p50 {:>8.1f} ms  p99 {:>8.1f} ms'.format(
+            name, result['rps'], result['p50'], result['p99']))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'time': datetime.utcnow().isoformat() + 'Z',
+                'config': {key: getattr(args, key)
+                           for key in ('users', 'sizes', 'requests', 'concurrency')},
+                'results': results
+            }, f, indent=4)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        print()
+        for name, change in compare(results, baseline).items():
+            print('{:<60} {:>+8.1%} req/s  p50 {:>+8.1%}     p99 {:>+8.1%}'.format(
+                name, change['rps'], change['p50'], change['p99']))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -14,16 +14,149 @@
 
 """Open Listling core."""
 
+from asyncio import Semaphore, ensure_future, gather, get_event_loop, sleep, wait
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from functools import partial
+from itertools import chain, islice
+import json
+from logging import getLogger
+from math import asin, cos, pi, radians, sin, sqrt
+import re
+from threading import local
 from time import time
+from weakref import WeakKeyDictionary
 
 import micro
-from micro import (Activity, Application, Collection, Editable, Location, Object, Orderable,
+from micro import (Application, Collection, Editable, Location, Object, Orderable,
                    Trashable, Settings, Event, WithContent)
-from micro.jsonredis import JSONRedis
-from micro.util import randstr, run_instant, str_or_none, ON
+from micro.jsonredis import JSONRedis, zpoptimed
+from micro.resource import (Analyzer, BrokenResourceError, ForbiddenResourceError,
+                            NoResourceError)
+from micro.util import parse_isotime, randstr, run_instant, str_or_none, ON
 
 from micro.jsonredis import RedisSortedSet
 
+from .metrics import Metrics, instrument_redis
+
+_UPDATE_BATCH_SIZE = 1000
+_JSON_CACHE_SIZE = 10000
+_CHANGES_LIMIT = 1000
+_RESOURCE_CONCURRENCY = 8
+_RESOURCE_CACHE_TTL = 24 * 60 * 60
+_RESOURCE_ERROR_CACHE_TTL = 10 * 60
+_JOB_WORKERS = 4
+_JOB_QUEUE_LIMIT = 10000
+_JOB_LOCAL_LIMIT = 100
+_JOB_ATTEMPTS = 5
+_JOB_POLL_INTERVAL = 60
+_REDIS_THREADS = 8
+_PURGE_BATCH_SIZE = 100
+_PURGE_INTERVAL = 60
+_ACTIVITY_MAX_EVENTS = 10000
+_ACTIVITY_TRIM_BATCH_SIZE = 100
+
+_TOUCH_SCRIPT = """\
+local revision = redis.call("incr", KEYS[1])
+redis.call("set", KEYS[3], ARGV[3])
+if ARGV[1] ~= "" then
+    redis.call("zadd", KEYS[2], revision, ARGV[1])
+    redis.call("zremrangebyrank", KEYS[2], 0, -tonumber(ARGV[2]) - 1)
+    if ARGV[4] == "absent" then
+        redis.call("srem", KEYS[4], ARGV[1])
+        redis.call("srem", KEYS[5], ARGV[1])
+    elseif ARGV[4] ~= "" then
+        redis.call("sadd", KEYS[4], ARGV[1])
+        if ARGV[4] == "checked" then
+            redis.call("sadd", KEYS[5], ARGV[1])
+        else
+            redis.call("srem", KEYS[5], ARGV[1])
+        end
+    end
+end
+return revision
+"""
+
+# Discard the oldest events of an activity, which exceed the maximum number ARGV[1] (0 meaning no
+# limit) or are older than the time ARGV[2] (empty meaning no limit), but at most ARGV[3]. Event
+# times are compared with second precision.
+_TRIM_SCRIPT = """\
+local limit = tonumber(ARGV[1])
+local length = redis.call("llen", KEYS[1])
+local count = 0
+while count < tonumber(ARGV[3]) and length > 0 do
+    local id = redis.call("lindex", KEYS[1], -1)
+    if limit == 0 or length <= limit then
+        if ARGV[2] == "" then
+            break
+        end
+        local data = redis.call("get", id)
+        if data and string.sub(cjson.decode(data).time, 1, 19) >= ARGV[2] then
+            break
+        end
+    end
+    redis.call("rpop", KEYS[1])
+    redis.call("del", id)
+    length = length - 1
+    count = count + 1
+end
+return count
+"""
+
+# Get the IDs of the events of an activity after the event with the sequence number ARGV[1] (empty
+# meaning from the start), at most ARGV[2]
+_PAGE_SCRIPT = """\
+local sequence = tonumber(redis.call("get", KEYS[2]) or redis.call("llen", KEYS[1]))
+local start = 0
+if ARGV[1] ~= "" then
+    start = math.max(sequence - tonumber(ARGV[1]) + 1, 0)
+end
+return {sequence, start, redis.call("lrange", KEYS[1], start, start + tonumber(ARGV[2]) - 1)}
+"""
+
+_INDEX_SCRIPT = """\
+for _, term in ipairs(redis.call("smembers", KEYS[1])) do
+    redis.call("srem", ARGV[1] .. term, ARGV[2])
+end
+redis.call("del", KEYS[1])
+for i = 3, #ARGV do
+    redis.call("sadd", ARGV[1] .. ARGV[i], ARGV[2])
+    redis.call("sadd", KEYS[1], ARGV[i])
+end
+"""
+
+_MGET_SCRIPT = """\
+local result = {}
+for i, key in ipairs(KEYS) do
+    if redis.call("type", key).ok == "hash" then
+        result[i] = redis.call("hgetall", key)
+    else
+        result[i] = redis.call("get", key)
+    end
+end
+return result
+"""
+# Registered multi-fetch scripts by connection pool, shared by clients and their pipelines
+_MGET_CACHE = WeakKeyDictionary()
+
+# Objects which are stored as Redis hashes with a field per attribute, so that only modified
+# attributes are written
+_HASH_PREFIXES = ('List:', 'Item:')
+
+# Redis commands which are buffered within a transaction
+_WRITE_COMMANDS = {'delete', 'geoadd', 'hdel', 'hset', 'incr', 'lpush', 'ltrim', 'publish', 'rpush',
+                   'sadd', 'set', 'srem', 'zadd', 'zrem', 'zremrangebyrank'}
+
+_TERM_PATTERN = re.compile(r'\w+')
+_LISTS_INDEX_PREFIX = 'lists.search.'
+# Latitude limit and earth radius (in meters) of Redis GEO commands
+_GEO_LAT_LIMIT = 85.05112878
+_EARTH_RADIUS = 6372797.560856
+
+_LOGGER = getLogger(__name__)
+
 _USE_CASES = {
     'simple': {'title': 'New list', 'features': []},
     'todo': {'title': 'New to-do list', 'features': ['check']},
@@ -108,11 +241,47 @@ _EXAMPLE_DATA = {
 }
 
 class Listling(Application):
-    """See :ref:`Listling`."""
+    """See :ref:`Listling`.
+
+    Lists retrieved via :attr:`lists` are kept in an identity map for the scope of a request, so
+    that a list (and its activity) is only materialized once, no matter how many items, permission
+    checks or events refer to it. The scope ends whenever the current :attr:`user` is set, which
+    happens at the start of every request.
+
+    Queries which may take long, like searches or pages of collections, accept *asynchronous*
+    :data:`micro.util.ON`, in which case they are run by :meth:`call_in_thread` and an awaitable is
+    returned.
+
+    .. attribute:: metrics
+
+       Performance :class:`listling.metrics.Metrics` of the app.
+
+    .. attribute:: trash_retention
+
+       Duration after which trashed items are permanently deleted.
+
+    .. attribute:: activity_max_events
+
+       Maximum number of events retained per activity, ``None`` meaning no limit.
+
+    .. attribute:: activity_max_age
+
+       Duration after which events are discarded from activities, ``None`` meaning no limit.
+    """
 
     class Lists(Collection):
         """See :ref:`Lists`."""
 
+        def __getitem__(self, key):
+            if isinstance(key, str):
+                # pylint: disable=protected-access; Listling is a friend
+                lst = self.app._identity_map.get(key)
+                if lst is None:
+                    lst = super().__getitem__(key)
+                    self.app._identity_map[key] = lst
+                return lst
+            return super().__getitem__(key)
+
         def create(self, use_case=None, description=None, title=None, v=1):
             """See :http:post:`/api/lists`."""
             if v == 1:
@@ -129,24 +298,32 @@ class Listling(Application):
             else:
                 raise NotImplementedError()
 
-            if not self.app.user:
-                raise PermissionError()
-            if use_case not in _USE_CASES:
-                raise micro.ValueError('use_case_unknown')
+            lst = self._make(use_case)
+            self._add(lst)
+            return lst
 
-            data = _USE_CASES[use_case]
-            id = 'List:{}'.format(randstr())
-            lst = List(
-                id=id, app=self.app, authors=[self.app.user.id], title=data['title'],
-                description=None, features=data['features'], mode='collaborate',
-                activity=Activity('{}.activity'.format(id), self.app, subscriber_ids=[]))
-            self.app.r.oset(lst.id, lst)
-            self.app.r.rpush(self.map_key, lst.id)
-            self.app.user.lists.add(lst, user=self.app.user)
-            self.app.activity.publish(
-                Event.create('create-list', None, {'lst': lst}, app=self.app))
+        async def fetch(self, id):
+            """Return the list with *id*, fetching it in a thread if needed.
+
+            See :meth:`Listling.call_in_thread`. If there is no list with *id*, a :exc:`KeyError`
+            is raised.
+            """
+            # pylint: disable=protected-access; Listling is a friend
+            lst = self.app._identity_map.get(id)
+            if lst is None:
+                lst = await self.app.call_in_thread(super().__getitem__, id)
+                self.app._identity_map[id] = lst
             return lst
 
+        def revision(self, id):
+            """Return the current revision of the list with *id*.
+
+            The revision is incremented whenever the list or any of its items is modified. ``None``
+            is returned if it is not known (yet).
+            """
+            revision = self.app.r.get(_revision_key(id))
+            return int(revision) if revision is not None else None
+
         def create_example(self, use_case, *, asynchronous=None):
             """See :http:post:`/api/lists/create-example`.
 
@@ -166,88 +343,516 @@ class Listling(Application):
                 '{}\n\n*This example was created just for you, so please feel free to play around.*'
                 .format(data[1]))
 
-            lst = self.create(use_case, v=2)
-            lst.edit(title=data[0], description=description)
-            for item in data[2]:
-                args = dict(item)
-                checked = args.pop('checked', False)
-                item = await lst.items.create(asynchronous=ON, **args)
-                if checked:
-                    item.check()
+            return await self.import_(data[0], data[2], description=description,
+                                      use_case=use_case)
+
+        async def import_(self, title, items, *, description=None, use_case='simple'):
+            """See :http:post:`/api/lists/import`.
+
+            *items* is a list of item attributes, as for a ``create`` operation of
+            :meth:`List.Items.batch`.
+            """
+            lst = self._make(use_case)
+            ops = [{**item, 'op': 'create'} for item in items]
+            # pylint: disable=protected-access; List is a friend
+            # Validate all items before anything is written, so that no list is left behind if the
+            # import is rejected
+            prepared = await lst.items._prepare(ops) if ops else None
+            with self.app.transaction():
+                self._add(lst)
+                lst.edit(title=title, description=description)
+                if ops:
+                    lst.items._apply(ops, *prepared)
             return lst
 
+        def _make(self, use_case):
+            # Make a new list for use_case, without storing it
+            if not self.app.user:
+                raise PermissionError()
+            if use_case not in _USE_CASES:
+                raise micro.ValueError('use_case_unknown')
+            data = _USE_CASES[use_case]
+            id = 'List:{}'.format(randstr())
+            return List(
+                id=id, app=self.app, authors=[self.app.user.id], title=data['title'],
+                description=None, features=data['features'], mode='collaborate',
+                activity=Activity('{}.activity'.format(id), self.app, subscriber_ids=[]))
+
+        def _add(self, lst):
+            # Store the new list lst
+            with self.app.transaction() as r:
+                r.oset(lst.id, lst)
+                r.rpush(self.map_key, lst.id)
+                self.app.user.lists.add(lst, user=self.app.user)
+                self.app.activity.publish(
+                    Event.create('create-list', None, {'lst': lst}, app=self.app))
+
     def __init__(self, redis_url='', email='bot@localhost', smtp_url='',
-                 render_email_auth_message=None, *, video_service_keys={}):
+                 render_email_auth_message=None, *, video_service_keys={},
+                 trash_retention=Trashable.RETENTION, activity_max_events=_ACTIVITY_MAX_EVENTS,
+                 activity_max_age=None):
+        self.metrics = Metrics()
+        self.trash_retention = trash_retention
+        self.activity_max_events = activity_max_events
+        self.activity_max_age = activity_max_age
+        self._identity_map = {}
+        self._json_cache = _JSONCache(_JSON_CACHE_SIZE, self.metrics)
+        self._event_relay = _EventRelay(self)
+        self._jobs = _JobQueue(self, {'notify': self._notify, 'push': self._push})
+        self._cache_token = None
+        self._executor = ThreadPoolExecutor(_REDIS_THREADS)
         super().__init__(redis_url, email, smtp_url, render_email_auth_message,
                          video_service_keys=video_service_keys)
-        self.types.update({'User': User, 'List': List, 'Item': Item})
+        self.r = _JSONRedis(self.r.r, self.r.encode, self.r.decode, on_set=self._on_set)
+        instrument_redis(self.r.r, self.metrics)
+        self._touch_script = self.r.register_script(_TOUCH_SCRIPT)
+        self._index_script = self.r.register_script(_INDEX_SCRIPT)
+        self._trim_script = self.r.register_script(_TRIM_SCRIPT)
+        self._page_script = self.r.register_script(_PAGE_SCRIPT)
+        self.analyzer = _ResourceAnalyzer(self, handlers=self.analyzer.handlers)
+        self.types.update({'User': User, 'Activity': Activity, 'List': List, 'Item': Item})
         self.lists = Listling.Lists((self, 'lists'))
 
+    @property
+    def user(self):
+        # pylint: disable=missing-docstring; already documented
+        return self._user
+
+    @user.setter
+    def user(self, value):
+        self._user = value
+        self._identity_map.clear()
+
     def do_update(self):
         version = self.r.get('version')
         if not version:
-            self.r.set('version', 7)
+            self.r.set('version', 14)
             return
 
         version = int(version)
         r = JSONRedis(self.r.r)
         r.caching = False
 
+        def lists():
+            return _scan(r, 'lists')
+        def items():
+            return (id for list_id in lists()
+                    for id in _scan(r, '{}.items'.format(list_id.decode())))
+
         # Deprecated since 0.3.0
         if version < 2:
-            lists = r.omget(r.lrange('lists', 0, -1))
-            for lst in lists:
+            def _update_list(lst, p):
                 lst['features'] = []
-                items = r.omget(r.lrange('{}.items'.format(lst['id']), 0, -1))
-                for item in items:
-                    item['checked'] = False
-                r.omset({item['id']: item for item in items})
-            r.omset({lst['id']: lst for lst in lists})
-            r.set('version', 2)
+                p.oset(lst['id'], lst)
+            def _update_item(item, p):
+                item['checked'] = False
+                p.oset(item['id'], item)
+            self._update_objects(r, '2-lists', lists(), _update_list)
+            self._update_objects(r, '2-items', items(), _update_item)
+            self._finish_update(r, 2)
 
         # Deprecated since 0.5.0
         if version < 3:
-            lists = r.omget(r.lrange('lists', 0, -1))
-            for lst in lists:
+            def _update_list(lst, p):
                 lst['activity'] = (
                     Activity('{}.activity'.format(lst['id']), app=self, subscriber_ids=[]).json())
-            r.omset({lst['id']: lst for lst in lists})
-            r.set('version', 3)
+                p.oset(lst['id'], lst)
+            self._update_objects(r, '3-lists', lists(), _update_list)
+            self._finish_update(r, 3)
 
         # Deprecated since 0.6.0
         if version < 4:
-            items = r.omget([id for list_id in r.lrange('lists', 0, -1)
-                             for id in r.lrange('{}.items'.format(list_id.decode()), 0, -1)])
-            for item in items:
+            def _update_item(item, p):
                 item['location'] = None
-            r.omset({item['id']: item for item in items})
-            r.set('version', 4)
+                p.oset(item['id'], item)
+            self._update_objects(r, '4-items', items(), _update_item)
+            self._finish_update(r, 4)
 
         # Deprecated since 0.7.0
         if version < 5:
-            items = r.omget(
-                [id for list_id in r.lrange('lists', 0, -1)
-                 for id in r.lrange('{}.items'.format(list_id.decode()), 0, -1)])
-            for item in items:
+            def _update_item(item, p):
                 item['resource'] = None
-            r.omset({item['id']: item for item in items})
-            r.set('version', 5)
+                p.oset(item['id'], item)
+            self._update_objects(r, '5-items', items(), _update_item)
+            self._finish_update(r, 5)
 
         # Deprecated since 0.11.0
         if version < 6:
-            lists = r.omget(r.lrange('lists', 0, -1))
-            for lst in lists:
+            def _update_list(lst, p):
                 lst['mode'] = 'collaborate'
-            r.omset({lst['id']: lst for lst in lists})
-            r.set('version', 6)
+                p.oset(lst['id'], lst)
+            self._update_objects(r, '6-lists', lists(), _update_list)
+            self._finish_update(r, 6)
 
         # Deprecated since 0.14.0
         if version < 7:
             now = time()
-            lists = r.omget(r.lrange('lists', 0, -1))
-            for lst in lists:
-                r.zadd('{}.lists'.format(lst['authors'][0]), {lst['id']: -now})
-            r.set('version', 7)
+            def _update_list(lst, p):
+                p.zadd('{}.lists'.format(lst['authors'][0]), {lst['id']: -now})
+            self._update_objects(r, '7-lists', lists(), _update_list)
+            self._finish_update(r, 7)
+
+        # Deprecated since 0.20.0
+        if version < 8:
+            def _update_list(lst, p):
+                key = '{}.items'.format(lst['id'])
+                ids = r.lrange(key, 0, -1)
+                p.delete(key)
+                if ids:
+                    p.zadd(key, {id: i for i, id in enumerate(ids)})
+            self._update_objects(r, '8-lists', lists(), _update_list)
+            self._finish_update(r, 8)
+
+        # Deprecated since 0.20.0
+        if version < 9:
+            def _update_list(lst, p):
+                self._index(p, _LISTS_INDEX_PREFIX, lst['id'], [lst['title'], lst['description']])
+            def _update_item(item, p):
+                self._index(p, _item_index_prefix(item['list_id']), item['id'],
+                            [] if item['trashed'] else [item['title'], item['text']])
+            self._update_objects(r, '9-lists', lists(), _update_list)
+            self._update_objects(
+                r, '9-items',
+                (id for list_id in lists()
+                 for id in r.zrange('{}.items'.format(list_id.decode()), 0, -1)),
+                _update_item)
+            self._finish_update(r, 9)
+
+        # Deprecated since 0.20.0
+        if version < 10:
+            def _update_item(item, p):
+                self._index_location(
+                    p, item['list_id'], item['id'],
+                    None if item['trashed'] or not item['location']
+                    else item['location']['coords'])
+            self._update_objects(
+                r, '10-items',
+                (id for list_id in lists()
+                 for id in r.zrange('{}.items'.format(list_id.decode()), 0, -1)),
+                _update_item)
+            self._finish_update(r, 10)
+
+        # Deprecated since 0.20.0
+        if version < 11:
+            def _update_list(lst, p):
+                self._repair_summary(r, lst['id'], p)
+            self._update_objects(r, '11-lists', lists(), _update_list)
+            self._finish_update(r, 11)
+
+        # Deprecated since 0.20.0
+        if version < 12:
+            def _update_object(obj, p):
+                p.delete(obj['id'])
+                p.hset(obj['id'], mapping={key: json.dumps(value) for key, value in obj.items()})
+            self._update_objects(r, '12-lists', lists(), _update_object)
+            self._update_objects(
+                r, '12-items',
+                (id for list_id in lists()
+                 for id in r.zrange('{}.items'.format(list_id.decode()), 0, -1)),
+                _update_object)
+            self._finish_update(r, 12)
+
+        # Deprecated since 0.20.0
+        if version < 13:
+            def _update_list(lst, p):
+                key = '{}.items'.format(lst['id'])
+                ranks = r.zrange(key, 0, -1, withscores=True)
+                items = _mget(r, [id for id, _ in ranks]) if ranks else []
+                trashed = {item['id']: rank
+                           for item, (_, rank) in zip(items, ranks) if item['trashed']}
+                if trashed:
+                    p.zrem(key, *trashed)
+                    p.zadd(_trash_key(lst['id']), trashed)
+            self._update_objects(r, '13-lists', lists(), _update_list)
+            self._finish_update(r, 13)
+
+        # Deprecated since 0.20.0
+        if version < 14:
+            def _update_list(lst, p):
+                activity_id = lst['activity']['id']
+                p.set(_sequence_key(activity_id), r.llen('{}.items'.format(activity_id)))
+            r.set(_sequence_key('Activity'), r.llen('Activity.items'))
+            self._update_objects(r, '14-lists', lists(), _update_list)
+            self._finish_update(r, 14)
+
+    def repair_summaries(self):
+        """Rebuild the summaries of all lists from their items and activity.
+
+        Repairs item counts and modification times which went out of sync with the source data,
+        e.g. after a manual modification of the database.
+        """
+        r = JSONRedis(self.r.r)
+        r.caching = False
+        def _update_list(lst, p):
+            self._repair_summary(r, lst['id'], p)
+        self._update_objects(r, 'repair-summaries', _scan(r, 'lists'), _update_list)
+        r.hdel('update_checkpoints', 'repair-summaries')
+
+    def compact_activities(self):
+        """Discard the events of all activities which exceed the retention policy.
+
+        Events are otherwise only discarded when a new one is published, so this applies a new
+        policy to existing data. The number of discarded events is returned.
+        """
+        count = 0
+        ids = chain(['Activity'],
+                    ('{}.activity'.format(id.decode()) for id in _scan(self.r, 'lists')))
+        for id in ids:
+            while True:
+                discarded = self._trim_activity(self.r, id)
+                count += discarded
+                if discarded < _ACTIVITY_TRIM_BATCH_SIZE:
+                    break
+        return count
+
+    @staticmethod
+    def _update_objects(r, step, ids, update):
+        # Apply update(obj, p) to the objects with the given ids, batch by batch. p is a pipeline
+        # for writes, which is executed together with a checkpoint after each batch, so that an
+        # interrupted update resumes where it stopped.
+        checkpoint = r.hget('update_checkpoints', step)
+        if checkpoint == b'done':
+            return
+        count = int(checkpoint or 0)
+        ids = islice(ids, count, None)
+
+        t = time()
+        logged = t
+        while True:
+            batch = list(islice(ids, _UPDATE_BATCH_SIZE))
+            if not batch:
+                break
+            p = JSONRedis(r.pipeline(), caching=False)
+            for obj in _mget(r, batch):
+                update(obj, p)
+            count += len(batch)
+            p.hset('update_checkpoints', step, count)
+            p.execute()
+
+            now = time()
+            if now - logged >= 10:
+                _LOGGER.info('Updating database (%s): %d objects, %.0f / s', step, count,
+                             count / (now - t))
+                logged = now
+        r.hset('update_checkpoints', step, 'done')
+
+    @staticmethod
+    def _repair_summary(r, list_id, p):
+        # Rebuild the summary of the list with list_id. The source data is read with r, which must
+        # not decode objects, and written with the pipeline p.
+        ids = r.zrange('{}.items'.format(list_id), 0, -1)
+        items = [item for item in _mget(r, ids) if not item['trashed']] if ids else []
+        event_ids = r.lrange('{}.activity.items'.format(list_id), 0, 0)
+        events = _mget(r, event_ids) if event_ids else []
+        keys = _summary_keys(list_id)
+        p.delete(keys['items'], keys['checked'])
+        if items:
+            p.sadd(keys['items'], *(item['id'] for item in items))
+        checked = [item['id'] for item in items if item['checked']]
+        if checked:
+            p.sadd(keys['checked'], *checked)
+        if events:
+            p.set(keys['modify_time'], parse_isotime(events[0]['time'], aware=True).timestamp())
+
+    @staticmethod
+    def _finish_update(r, version):
+        p = r.pipeline()
+        p.set('version', version)
+        p.delete('update_checkpoints')
+        p.execute()
+
+    async def call_in_thread(self, func, *args):
+        """Call *func* with *args* in a thread and return the result.
+
+        Blocking Redis queries are run this way, so that a slow reply does not stall the event loop
+        and other requests. *func* must not depend on the current :attr:`user`, which may change
+        while awaiting. The Redis round-trips are recorded in the current :class:`Metrics.Record`.
+        """
+        return await get_event_loop().run_in_executor(self._executor,
+                                                      self.metrics.bind(partial(func, *args)))
+
+    @contextmanager
+    def transaction(self):
+        """Context manager which applies the Redis writes of a mutation at once.
+
+        Within the block, writes via :attr:`r` are buffered in a MULTI/EXEC pipeline, which is
+        executed atomically in a single round-trip at the end of the block. Reads are still
+        performed immediately, so the block must not depend on reading its own writes. If the block
+        raises an exception, the writes are discarded. Effects within the process, like notifying
+        live streams, are deferred until the writes are applied. The pipeline is returned as
+        context, to be used for writes where a client is passed explicitly. Nested blocks join the
+        outer transaction.
+
+        The transaction belongs to the calling thread, so transactions of other threads (see
+        :meth:`call_in_thread`) are independent. The block must not await, because writes of
+        concurrent tasks of the event loop would be buffered as well.
+        """
+        if self.r.unit is not None:
+            yield self.r.unit
+            return
+        self.r.unit = self.r.multi()
+        try:
+            yield self.r.unit
+            self.r.unit.execute()
+        except Exception:
+            self.r.unit.discard()
+            raise
+        finally:
+            self.r.unit = None
+
+    def share_caches(self):
+        """Keep in-process caches coherent with other processes of the app.
+
+        Modifications are announced via Redis pub/sub, invalidating cached data of the modified
+        objects in all other processes. Must be called in every process, with a running event loop.
+        """
+        self._cache_token = randstr()
+        self._event_relay.listen('invalidations', self._on_invalidation)
+
+    def _on_invalidation(self, data):
+        token, key = data.split(' ', 1)
+        if token != self._cache_token:
+            self._json_cache.invalidate(key)
+            self.r.uncache(key)
+
+    def _invalidate(self, r, key):
+        # Invalidate cached data depending on key, in this and all other processes
+        self._json_cache.invalidate(key)
+        if self._cache_token:
+            r.r.publish('invalidations', '{} {}'.format(self._cache_token, key))
+
+    def _on_set(self, r, key, object, fields=None):
+        # fields are the names of the modified attributes, if known
+        def modified(*names):
+            return fields is None or not fields.isdisjoint(names)
+
+        self._invalidate(r, key)
+        if isinstance(object, List):
+            self._touch(r, object.id)
+            if modified('title', 'description'):
+                self._index(r, _LISTS_INDEX_PREFIX, object.id, [object.title, object.description])
+        elif isinstance(object, Item):
+            # pylint: disable=protected-access; Item is a friend
+            self._touch(r, object._list_id, object.id, _item_state(object))
+            if modified('title', 'text', 'trashed'):
+                self._index(r, _item_index_prefix(object._list_id), object.id,
+                            [] if object.trashed else [object.title, object.text])
+            if modified('location', 'trashed'):
+                self._index_location(
+                    r, object._list_id, object.id,
+                    None if object.trashed or not object.location else object.location.coords)
+        elif isinstance(object, Event):
+            # Announce list events to the live streams of all processes
+            obj = object.object
+            list_id = (obj.id if isinstance(obj, List) else
+                       obj._list_id if isinstance(obj, Item) else None)
+            if list_id:
+                r.r.publish(_events_channel(list_id), object.id)
+
+    def _touch(self, r, list_id, item_id=None, state=''):
+        # Increment the revision of the list with list_id, update its modification time and log the
+        # item with item_id, if any, as changed. The summary is updated with the new state of the
+        # item, either present, checked or absent (deleted or trashed), unless state is empty. r is
+        # the JSONRedis client (or pipeline) to use.
+        keys = _summary_keys(list_id)
+        self._touch_script(
+            keys=[_revision_key(list_id), '{}.changes'.format(list_id), keys['modify_time'],
+                  keys['items'], keys['checked']],
+            args=[item_id or '', _CHANGES_LIMIT, time(), state], client=r.r)
+
+    def _trim_activity(self, r, activity_id):
+        # Discard the oldest events of the activity with activity_id which exceed the retention
+        # policy, at most _ACTIVITY_TRIM_BATCH_SIZE. r is the JSONRedis client (or pipeline) to use.
+        cutoff = ((datetime.utcnow() - self.activity_max_age).isoformat()[:19]
+                  if self.activity_max_age else '')
+        return self._trim_script(
+            keys=['{}.items'.format(activity_id)],
+            args=[self.activity_max_events or 0, cutoff, _ACTIVITY_TRIM_BATCH_SIZE], client=r.r)
+
+    def start_jobs(self, workers=_JOB_WORKERS):
+        """Start performing background jobs, at most *workers* at a time.
+
+        Jobs are shared by all processes, e.g. notifying the subscribers of an :class:`Activity`.
+        A task is returned, which stops all workers when cancelled.
+        """
+        return ensure_future(self._jobs.work(workers))
+
+    def start_empty_trash(self):
+        """Start the job which purges items trashed longer than :attr:`trash_retention`.
+
+        Items are deleted in batches of :meth:`purge_trash`, one after another while there are any
+        due, then the job pauses for a while. Batches are run on the event loop, like requests, so
+        they share the caches of the app safely. Other tasks may run between batches.
+        """
+        async def _empty_trash():
+            while True:
+                # pylint: disable=broad-except; catch unhandled exceptions
+                try:
+                    count = self.purge_trash()
+                except Exception as e:
+                    get_event_loop().call_exception_handler({
+                        'message': 'Unexpected exception in purge_trash()',
+                        'exception': e
+                    })
+                    count = 0
+                await sleep(0 if count == _PURGE_BATCH_SIZE else _PURGE_INTERVAL)
+        return ensure_future(_empty_trash())
+
+    def purge_trash(self, size=_PURGE_BATCH_SIZE):
+        """Permanently delete up to *size* items trashed longer than :attr:`trash_retention`.
+
+        The items are deleted in a single transaction. The number of purged items is returned.
+        """
+        # micro_trash scores are the trash times plus the default retention
+        cutoff = (datetime.now(timezone.utc) - self.trash_retention +
+                  Trashable.RETENTION).timestamp()
+        ids = self.r.zrangebyscore('micro_trash', '-inf', cutoff, start=0, num=size)
+        if not ids:
+            return 0
+        items = _mget(self.r, [id.decode() for id in ids])
+        with self.transaction() as r:
+            for item in items:
+                item.delete()
+            r.zrem('micro_trash', *ids)
+        return len(ids)
+
+    async def _notify(self, event_id, subscriber_ids):
+        # Fan out the event with event_id to the subscribers with subscriber_ids, with an individual
+        # job per device notification
+        event = self.r.oget(event_id)
+        if not event:
+            return
+        for user in _mget(self.r, subscriber_ids):
+            if user.id != event.user.id and user.device_notification_status == 'on':
+                self._jobs.enqueue('push', user.id, event.id)
+
+    async def _push(self, user_id, event_id):
+        user = self.r.oget(user_id)
+        event = self.r.oget(event_id)
+        if not (user and event) or user.device_notification_status != 'on':
+            return
+        # pylint: disable=protected-access; User is a friend
+        try:
+            await user._send_device_notification(user.push_subscription, event)
+        except micro.ValueError as e:
+            if e.code != 'push_subscription_invalid':
+                raise
+            user._disable_device_notifications(reason='expired')
+
+    def _index(self, r, prefix, id, texts):
+        # Update the search index for the object with id, i.e. the sets at prefix + term, with the
+        # terms of the given texts. r is the Redis client (or pipeline) to use.
+        self._index_script(keys=['{}.terms'.format(id)], args=[prefix, id, *_terms(*texts)],
+                           client=r.r)
+
+    @staticmethod
+    def _index_location(r, list_id, id, coords):
+        # Update the geospatial index of the list with list_id for the item with id, located at
+        # coords, if any. r is the Redis client (or pipeline) to use.
+        if coords:
+            r.geoadd(_geo_key(list_id), coords[1], _clamp_lat(coords[0]), id)
+        else:
+            r.zrem(_geo_key(list_id), id)
 
     def create_user(self, data):
         return User(**data)
@@ -260,6 +865,58 @@ class Listling(Application):
             provider_description={}, feedback_url=None, staff=[], push_vapid_private_key=None,
             push_vapid_public_key=None, v=2)
 
+class Activity(micro.Activity):
+    """See :ref:`Activity`.
+
+    Subscribers are notified by a background job, so publishing an event takes constant time,
+    independent of the number of subscribers. On publish, the oldest events which exceed the
+    retention policy of the app are discarded, see :attr:`Listling.activity_max_events` and
+    :attr:`Listling.activity_max_age`.
+
+    Events are numbered by a sequence, which serves as cursor for :meth:`page`.
+    """
+
+    def publish(self, event):
+        with self.app.transaction() as r:
+            r.oset(event.id, event)
+            r.lpush(self.list_key, event.id)
+            r.incr(_sequence_key(self.id))
+            # pylint: disable=protected-access; Listling is a friend
+            self.app._trim_activity(r, self.id)
+            if self._subscriber_ids:
+                # pylint: disable=protected-access; Listling is a friend
+                self.app._jobs.enqueue('notify', event.id, self._subscriber_ids)
+            # Only events which actually happened are streamed
+            r.defer(partial(self._stream, event))
+
+    def _stream(self, event):
+        for stream in self._streams:
+            stream.put_nowait(event)
+
+    def page(self, cursor=None, limit=100, *, asynchronous=None):
+        """Return the events after *cursor*, at most *limit*, and the cursor of the next page.
+
+        Events are ordered latest first. Other than a slice, a cursor stays valid while events are
+        published in the meantime. The cursor of the last page is ``None``. If *cursor* is
+        malformed, a :exc:`micro.ValueError` (``bad_cursor_format``) is raised.
+        """
+        if asynchronous is ON:
+            return self.app.call_in_thread(self.page, cursor, limit)
+        if cursor:
+            # A cursor is the sequence number of the last event on the previous page
+            try:
+                cursor = int(cursor)
+            except ValueError:
+                raise micro.ValueError('bad_cursor_format')
+            if cursor < 1:
+                raise micro.ValueError('bad_cursor_format')
+        # pylint: disable=protected-access; Listling is a friend
+        sequence, start, ids = self.app._page_script(
+            keys=[self.list_key, _sequence_key(self.id)], args=[cursor or '', limit])
+        events = _mget(self.app.r, ids) if ids else []
+        last = sequence - start - len(ids) + 1
+        return events, str(last) if len(ids) == limit and last > 1 else None
+
 class User(micro.User):
     """See :ref:`User`."""
 
@@ -277,6 +934,8 @@ class User(micro.User):
             if user != getattr(self, 'user'):
                 raise PermissionError()
             self.app.r.zadd(self.ids.key, {lst.id: -time()})
+            # pylint: disable=protected-access; Listling is a friend
+            self.app._invalidate(self.app.r, self.ids.key)
 
         def remove(self, lst, *, user):
             """See :http:delete:`/users/(id)/lists/(list-id)`.
@@ -291,6 +950,8 @@ class User(micro.User):
             if self.app.r.zrem(self.ids.key, lst.id) == 0:
                 raise micro.ValueError(
                     'No lst {} in lists of user {}'.format(lst.id, getattr(self, 'user').id))
+            # pylint: disable=protected-access; Listling is a friend
+            self.app._invalidate(self.app.r, self.ids.key)
 
         def read(self, *, user):
             """Return collection for reading."""
@@ -298,6 +959,92 @@ class User(micro.User):
                 raise PermissionError()
             return self
 
+        def page(self, cursor=None, limit=100, *, asynchronous=None):
+            """Return the lists after *cursor*, at most *limit*, and the cursor of the next page.
+
+            Other than a slice, a cursor stays valid while lists are added in the meantime. The
+            cursor of the last page is ``None``. If *cursor* is malformed, a
+            :exc:`micro.ValueError` (``bad_cursor_format``) is raised.
+            """
+            if asynchronous is ON:
+                return self.app.call_in_thread(self.page, cursor, limit)
+            key = self.ids.key
+            start = '-inf'
+            offset = 0
+            if cursor:
+                # A cursor is the score and ID of the last list on the previous page. Lists with the
+                # same score are ordered by ID, so the ones up to and including the last list are
+                # skipped.
+                try:
+                    score, id = cursor.split(',', 1)
+                    score = float(score)
+                except ValueError:
+                    raise micro.ValueError('bad_cursor_format')
+                p = self.app.r.pipeline()
+                p.zscore(key, id)
+                p.zrank(key, id)
+                p.zcount(key, '-inf', '({!r}'.format(score))
+                current_score, rank, before = p.execute()
+                if current_score == score:
+                    start = repr(score)
+                    offset = rank - before + 1
+                else:
+                    # The last list was removed or re-added, so continue after its score
+                    start = '({!r}'.format(score)
+
+            results = self.app.r.zrangebyscore(key, start, '+inf', start=offset, num=limit,
+                                               withscores=True)
+            lists = _mget(self.app.r, [id.decode() for id, _ in results])
+            cursor = None
+            if len(results) == limit:
+                id, score = results[-1]
+                cursor = '{!r},{}'.format(score, id.decode())
+            return lists, cursor
+
+        def __getitem__(self, key):
+            # Optimized to fetch slices in a single round-trip
+            if isinstance(key, slice):
+                return _mget(self.app.r, [id.decode() for id in self.ids[key]])
+            return super().__getitem__(key)
+
+        def json(self, restricted=False, include=False, *, slc=None):
+            # Optimized to fetch the summaries of the slice in a single round-trip
+            if not slc:
+                return super().json(restricted, include, slc=slc)
+            lists = self[slc]
+            start = 0 if slc.start is None else slc.start
+            return {
+                'count': len(self),
+                'items': self.items_json(lists, restricted, include),
+                'slice': [start, start + len(lists)]
+            }
+
+        def items_json(self, lists, restricted=False, include=False):
+            """Return the JSON representations of *lists*, e.g. a :meth:`page`.
+
+            The summaries of all lists are fetched in a single round-trip.
+            """
+            summaries = _summaries(self.app.r, lists) if restricted else [None] * len(lists)
+            return [lst.json(restricted, include, summary=summary)
+                    for lst, summary in zip(lists, summaries)]
+
+        def search(self, query, *, asynchronous=None):
+            """See :http:get:`/api/users/(id)/lists/search`."""
+            if asynchronous is ON:
+                return self.app.call_in_thread(self.search, query)
+            terms = _terms(query)
+            if not terms:
+                return []
+            # Intersect with the term sets and keep the order of the collection
+            key = '{}.search.{}'.format(self.ids.key, randstr())
+            p = self.app.r.pipeline()
+            p.zinterstore(key, {self.ids.key: 1,
+                                **{_LISTS_INDEX_PREFIX + term: 0 for term in terms}})
+            p.zrange(key, 0, -1)
+            p.delete(key)
+            ids = p.execute()[1]
+            return _mget(self.app.r, [id.decode() for id in ids]) if ids else []
+
     def __init__(self, **data):
         super().__init__(**data)
         self.lists = User.Lists(self)
@@ -316,9 +1063,31 @@ class List(Object, Editable):
         'collaborate': {'user': {'list-modify', 'item-modify'}},
         'view':        {'user': set()}
     }
+    _SUMMARY_ATTRS = ['items', 'revision', 'item_count', 'checked_item_count', 'modify_time']
 
     class Items(Collection, Orderable):
-        """See :ref:`Items`."""
+        """See :ref:`Items`.
+
+        Items are ordered by rank, stored as score of a Redis sorted set. A moved item is ranked
+        halfway between its new neighbors, so that membership tests, moves and removals take
+        logarithmic time.
+
+        Only present items are part of the collection. Trashed items are kept in a separate index
+        with their rank, so that a restored item returns to its position, but may still be
+        retrieved by ID.
+        """
+        # We use setattr / getattr to work around a Pylint error for Generic classes (see
+        # https://github.com/PyCQA/pylint/issues/2443)
+
+        def __init__(self, lst):
+            super().__init__(RedisSortedSet('{}.items'.format(lst.id), lst.app.r), app=lst.app)
+            setattr(self, 'lst', lst)
+
+        def __getitem__(self, key):
+            if (isinstance(key, str) and key not in self and
+                    self.app.r.zscore(_trash_key(getattr(self, 'lst').id), key) is not None):
+                return self.app.r.oget(key, default=ReferenceError, expect=self.expect)
+            return super().__getitem__(key)
 
         def create(self, title, text=None, *, resource=None, location=None, asynchronous=None):
             """See :http:post:`/api/lists/(id)/items`.
@@ -335,28 +1104,291 @@ class List(Object, Editable):
             return coro if asynchronous is ON else run_instant(coro)
 
         async def _create(self, title, *, text=None, resource=None, location=None):
+            lst = getattr(self, 'lst')
+            # pylint: disable=protected-access; List is a friend
+            lst._check_permission(self.app.user, 'list-modify')
+            item = await self._make_item(title, text=text, resource=resource, location=location)
+            rank = self._end_rank()
+            with self.app.transaction() as r:
+                r.oset(item.id, item)
+                r.zadd(self.ids.key, {item.id: rank})
+                lst.activity.publish(
+                    Event.create('list-create-item', lst, {'item': item}, self.app))
+            return item
+
+        def move(self, item, to):
+            # pylint: disable=protected-access; List is a friend
+            getattr(self, 'lst')._check_permission(self.app.user, 'list-modify')
+            if to:
+                if to.id not in self:
+                    raise micro.ValueError('to_not_found')
+                if to == item:
+                    # No op
+                    return
+            if item.id not in self:
+                raise micro.ValueError('item_not_found')
+
+            rank = self._rank_after(to, item)
+            if rank is None:
+                self._rerank()
+                rank = self._rank_after(to, item)
+            with self.app.transaction() as r:
+                r.zadd(self.ids.key, {item.id: rank})
+                # pylint: disable=protected-access; Listling is a friend
+                self.app._touch(r, getattr(self, 'lst').id, item.id)
+
+        async def batch(self, ops):
+            """See :http:post:`/api/lists/(id)/items/batch`."""
+            items, ranks = await self._prepare(ops)
+            self._apply(ops, items, ranks)
+            return items
+
+        async def _prepare(self, ops):
+            # Validate the batch operations ops and make the items to create, without writing
+            # anything. The affected items and the ranks of the existing ones are returned.
+            lst = getattr(self, 'lst')
+            if not ops:
+                raise micro.ValueError('ops_empty')
+            types = {op.get('op') for op in ops}
+            if not types <= {'create', 'check', 'uncheck', 'trash', 'restore'}:
+                raise micro.ValueError('op_unknown')
             # pylint: disable=protected-access; List is a friend
-            self.host[0]._check_permission(self.app.user, 'list-modify')
+            if 'create' in types:
+                lst._check_permission(self.app.user, 'list-modify')
+            if types - {'create'}:
+                lst._check_permission(self.app.user, 'item-modify')
+            if ((types & {'check', 'uncheck'} or
+                 any(op.get('checked') for op in ops if op['op'] == 'create')) and
+                    'check' not in lst.features):
+                raise micro.ValueError('feature_disabled')
+
+            ids = list({op.get('item_id') for op in ops if op['op'] != 'create'})
+            p = self.app.r.pipeline()
+            for id in ids:
+                p.zscore(self.ids.key, id or '')
+                p.zscore(_trash_key(lst.id), id or '')
+            scores = p.execute()
+            ranks = {id: rank if rank is not None else trashed_rank
+                     for id, rank, trashed_rank in zip(ids, scores[::2], scores[1::2])}
+            if None in ranks.values():
+                raise micro.ValueError('item_not_found')
+            existing = {item.id: item for item in _mget(self.app.r, ids)} if ids else {}
+
+            semaphore = Semaphore(_RESOURCE_CONCURRENCY)
+            async def make_item(op):
+                async with semaphore:
+                    item = await self._make_item(
+                        op.get('title'), text=op.get('text'), resource=op.get('resource'),
+                        location=op.get('location'))
+                item.checked = bool(op.get('checked'))
+                return item
+            creates = [op for op in ops if op['op'] == 'create']
+            if any(op.get('resource') for op in creates):
+                # Resources are analyzed concurrently, but bounded to not overwhelm remote hosts
+                created = await gather(*(make_item(op) for op in creates))
+            else:
+                # Without resources, items are made without suspending, so that synchronous
+                # callers (see run_instant()) are supported
+                created = [await make_item(op) for op in creates]
+            created = iter(created)
+            items = [next(created) if op['op'] == 'create' else existing[op['item_id']]
+                     for op in ops]
+            return items, ranks
+
+        def _apply(self, ops, items, ranks):
+            # Apply the batch operations ops, prepared by _prepare(), at once
+            lst = getattr(self, 'lst')
+            rank = self._end_rank()
+            with self.app.transaction() as r:
+                for op, item in zip(ops, items):
+                    if op['op'] == 'create':
+                        r.zadd(self.ids.key, {item.id: rank})
+                        rank += 1
+                    elif op['op'] in {'check', 'uncheck'}:
+                        item.checked = op['op'] == 'check'
+                    elif op['op'] == 'trash' and not item.trashed:
+                        item.trashed = True
+                        t = (datetime.now(timezone.utc) + Trashable.RETENTION).timestamp()
+                        r.zadd('micro_trash', {item.id.encode(): t})
+                        self._index_trashed(r, item, ranks[item.id])
+                    elif op['op'] == 'restore' and item.trashed:
+                        item.trashed = False
+                        r.zrem('micro_trash', item.id.encode())
+                        self._index_trashed(r, item, ranks[item.id])
+                for item in {item.id: item for item in items}.values():
+                    r.oset(item.id, item)
+                lst.activity.publish(Event.create(
+                    'list-items-batch', lst,
+                    {'ops': [{'op': op['op'], 'item': item.id} for op, item in zip(ops, items)]},
+                    self.app))
+
+        def search(self, query, *, asynchronous=None):
+            """See :http:get:`/api/lists/(id)/items/search`."""
+            if asynchronous is ON:
+                return self.app.call_in_thread(self.search, query)
+            terms = _terms(query)
+            if not terms:
+                return []
+            lst = getattr(self, 'lst')
+            ids = self.app.r.sinter([_item_index_prefix(lst.id) + term for term in terms])
+            return _mget(self.app.r, self._order(ids))
+
+        def near(self, coords, radius, *, asynchronous=None):
+            """Return the present items located within *radius* meters of *coords*.
+
+            Items are ordered by distance, nearest first.
+            """
+            if asynchronous is ON:
+                return self.app.call_in_thread(self.near, coords, radius)
+            if radius <= 0:
+                raise micro.ValueError('out_of_range_radius')
+            lat, lng = _check_coords(coords)
+            ids = self.app.r.georadius(_geo_key(getattr(self, 'lst').id), lng, _clamp_lat(lat),
+                                       radius, unit='m', sort='ASC')
+            return _mget(self.app.r, [id.decode() for id in ids])
+
+        def within(self, bbox, *, asynchronous=None):
+            """Return the present items located within the bounding box *bbox*.
+
+            *bbox* is a tuple ``(south, west, north, east)``. If *west* is greater than *east*, the
+            box crosses the antimeridian.
+            """
+            if asynchronous is ON:
+                return self.app.call_in_thread(self.within, bbox)
+            south, west = _check_coords(bbox[0:2])
+            north, east = _check_coords(bbox[2:4])
+            if south > north:
+                raise micro.ValueError('out_of_range_bbox')
+            width = east - west if east >= west else east - west + 360
+
+            # Query the circle around the box, then drop the items outside of it
+            lat = (south + north) / 2
+            lng = (west + width / 2 + 180) % 360 - 180
+            radius = pi * _EARTH_RADIUS
+            if width <= 180:
+                radius = max(_distance((lat, lng), (south, west)),
+                             _distance((lat, lng), (north, west)))
+            results = self.app.r.georadius(_geo_key(getattr(self, 'lst').id), lng, _clamp_lat(lat),
+                                           radius + 1, unit='m', withcoord=True)
+            ids = [id for id, (x, y) in results
+                   if _clamp_lat(south) <= y <= _clamp_lat(north) and (x - west) % 360 <= width]
+            return _mget(self.app.r, self._order(ids))
+
+        def batches(self, size=100, *, trashed=False):
+            """Iterate over all items in batches of *size*.
+
+            If *trashed* is set, iterate over the trashed items instead. Each batch costs two Redis
+            round-trips, independent of *size*, and only one batch is held in memory at a time.
+            """
+            start = 0
+            while True:
+                ids = self._batch_ids(start, size, trashed)
+                if not ids:
+                    break
+                yield _mget(self.app.r, ids)
+                start += size
+
+        def view_batches(self, size=100, *, trashed=False):
+            """Iterate over lightweight :class:`ItemView` s of all items in batches of *size*.
+
+            Like :meth:`batches`, but no full :class:`Item` is materialized. The authors of the
+            items are fetched once per iteration.
+            """
+            users = {}
+            start = 0
+            while True:
+                ids = self._batch_ids(start, size, trashed)
+                if not ids:
+                    break
+                yield [ItemView(id, self.app, fields, users)
+                       for id, fields in zip(ids, _fetch_fields(self.app.r, ids))
+                       if fields is not None]
+                start += size
+
+        async def _make_item(self, title, *, text=None, resource=None, location=None):
             attrs = await WithContent.process_attrs({'text': text, 'resource': resource},
                                                     app=self.app)
             if str_or_none(title) is None:
                 raise micro.ValueError('title_empty')
-
-            item = Item(
+            return Item(
                 id='Item:{}'.format(randstr()), app=self.app, authors=[self.app.user.id],
                 trashed=False, text=attrs['text'], resource=attrs['resource'],
-                list_id=self.host[0].id, title=title,
+                list_id=getattr(self, 'lst').id, title=title,
                 location=location.json() if location else None, checked=False)
-            self.app.r.oset(item.id, item)
-            self.app.r.rpush(self.map_key, item.id)
-            self.host[0].activity.publish(
-                Event.create('list-create-item', self.host[0], {'item': item}, self.app))
-            return item
 
-        def move(self, item, to):
-            # pylint: disable=protected-access; List is a friend
-            self.host[0]._check_permission(self.app.user, 'list-modify')
-            super().move(item, to)
+        def _order(self, ids):
+            # Put the item ids in list order, skipping those not in the list (anymore)
+            p = self.app.r.pipeline()
+            for id in ids:
+                p.zscore(self.ids.key, id)
+            ranks = p.execute() if ids else []
+            return [id.decode() for _, id in
+                    sorted((rank, id) for rank, id in zip(ranks, ids) if rank is not None)]
+
+        def _end_rank(self):
+            # Trashed items keep their rank, so new items are ranked after them as well
+            p = self.app.r.pipeline()
+            for key in (self.ids.key, _trash_key(getattr(self, 'lst').id)):
+                p.zrange(key, -1, -1, withscores=True)
+            ranks = [last[0][1] for last in p.execute() if last]
+            return max(ranks) + 1 if ranks else 0
+
+        def _rank_after(self, to, item):
+            # Rank for item placed after to, or at the front if to is None. None if there is no room
+            # left between the neighbors.
+            if to:
+                lo = self.app.r.zscore(self.ids.key, to.id)
+                start = self.app.r.zrank(self.ids.key, to.id) + 1
+            else:
+                lo = None
+                start = 0
+            neighbors = [
+                score for id, score in self.app.r.zrange(self.ids.key, start, start + 1,
+                                                         withscores=True)
+                if id != item.id.encode()]
+            hi = neighbors[0] if neighbors else None
+            if lo is None:
+                return 0 if hi is None else hi - 1
+            if hi is None:
+                return lo + 1
+            rank = (lo + hi) / 2
+            return rank if lo < rank < hi else None
+
+        def _rerank(self):
+            # Renumber present and trashed items together, so that trashed items are restored to
+            # their position
+            keys = (self.ids.key, _trash_key(getattr(self, 'lst').id))
+            p = self.app.r.pipeline()
+            for key in keys:
+                p.zrange(key, 0, -1, withscores=True)
+            ranked = sorted((score, id, key) for key, results in zip(keys, p.execute())
+                            for id, score in results)
+            ranks = {key: {} for key in keys}
+            for i, (_, id, key) in enumerate(ranked):
+                ranks[key][id] = i
+            p = self.app.r.pipeline()
+            for key, mapping in ranks.items():
+                if mapping:
+                    p.zadd(key, mapping)
+            p.execute()
+
+        def _batch_ids(self, start, size, trashed):
+            key = _trash_key(getattr(self, 'lst').id) if trashed else self.ids.key
+            return [id.decode() for id in self.app.r.zrange(key, start, start + size - 1)]
+
+        def _index_trashed(self, r, item, rank=None):
+            # Move item to the index of trashed items, or back if it is not trashed (anymore),
+            # keeping its rank. Writes are made with r.
+            src = self.ids.key
+            dst = _trash_key(getattr(self, 'lst').id)
+            if not item.trashed:
+                src, dst = dst, src
+            if rank is None:
+                rank = self.app.r.zscore(src, item.id)
+                if rank is None:
+                    return
+            r.zrem(src, item.id)
+            r.zadd(dst, {item.id: rank})
 
     def __init__(self, *, id, app, authors, title, description, features, mode, activity):
         super().__init__(id=id, app=app)
@@ -365,7 +1397,7 @@ class List(Object, Editable):
         self.description = description
         self.features = features
         self.mode = mode
-        self.items = List.Items((self, 'items'))
+        self.items = List.Items(self)
         self.activity = activity
         self.activity.host = self
 
@@ -387,7 +1419,11 @@ class List(Object, Editable):
         if 'mode' in attrs:
             self.mode = attrs['mode']
 
-    def json(self, restricted=False, include=False):
+    def json(self, restricted=False, include=False, *, summary=None):
+        # pylint: disable=arguments-differ; extension
+        # summary is the prefetched summary, if any
+        if restricted and summary is None:
+            summary = self._summary()
         return {
             **super().json(restricted, include),
             **Editable.json(self, restricted, include),
@@ -396,17 +1432,119 @@ class List(Object, Editable):
             'features': self.features,
             'mode': self.mode,
             'activity': self.activity.json(restricted),
-            **({'items': self.items.json(restricted=restricted, include=include)} if restricted
-               else {}),
+            **(summary if restricted else {})
         }
 
+    def stream(self):
+        """Return a live stream of events of the list.
+
+        Events are received via Redis pub/sub, so the stream includes events published by any
+        process.
+        """
+        # pylint: disable=protected-access; Listling is a friend
+        return self.app._event_relay.stream(self.id)
+
+    @property
+    def revision(self):
+        """Current revision of the list, incremented whenever the list or an item is modified."""
+        return self.app.lists.revision(self.id) or 0
+
+    def summary(self):
+        """Return a summary of the list.
+
+        The result is an object ``{"item_count", "checked_item_count", "modify_time"}``, where
+        *item_count* and *checked_item_count* are the number of present and checked items and
+        *modify_time* is the time the list or any of its items was last modified. The summary is
+        maintained on modification, so it is available in constant time.
+        """
+        summary = self._summary()
+        return {key: summary[key] for key in ('item_count', 'checked_item_count', 'modify_time')}
+
+    def changes(self, since, *, asynchronous=None):
+        """See :http:get:`/api/lists/(id)/changes`.
+
+        A list of changes is returned, each a tuple ``(id, item, after_id)``, where *item* is
+        ``None`` if the item with *id* has been deleted.
+        """
+        if asynchronous is ON:
+            return self.app.call_in_thread(self.changes, since)
+        key = '{}.changes'.format(self.id)
+        revision = self.revision
+        if not 0 <= since <= revision:
+            raise micro.ValueError('since_out_of_range')
+        p = self.app.r.pipeline()
+        p.zcard(key)
+        p.zrange(key, 0, 0, withscores=True)
+        p.zrangebyscore(key, '({}'.format(since), '+inf')
+        count, oldest, ids = p.execute()
+        # If the log is full, older changes may have been discarded
+        if count >= _CHANGES_LIMIT and since < oldest[0][1] - 1:
+            raise micro.ValueError('since_expired')
+        ids = [id.decode() for id in ids]
+
+        # Order changes by position, deleted items first and trashed items last, so that they can
+        # be applied one by one. Trashed items are positioned among the trashed items.
+        keys = [self.items.ids.key, _trash_key(self.id)]
+        p = self.app.r.pipeline()
+        for id in ids:
+            for key in keys:
+                p.zrank(key, id)
+        results = p.execute()
+        positions = []
+        for id, rank, trashed_rank in zip(ids, results[::2], results[1::2]):
+            if rank is not None:
+                positions.append((id, 0, rank))
+            elif trashed_rank is not None:
+                positions.append((id, 1, trashed_rank))
+            else:
+                positions.append((id, -1, None))
+        positions.sort(key=lambda x: (x[1], x[2] or 0))
+        p = self.app.r.pipeline()
+        for _, index, rank in positions:
+            if rank:
+                p.zrange(keys[index], rank - 1, rank - 1)
+        predecessors = iter(p.execute())
+        items = {item.id: item for item in _mget(self.app.r, ids)} if ids else {}
+
+        changes = []
+        for id, index, rank in positions:
+            predecessor = next(predecessors) if rank else None
+            changes.append((id, items.get(id) if index != -1 else None,
+                            predecessor[0].decode() if predecessor else None))
+        return revision, changes
+
+    def encoded_json(self, restricted=False, include=False):
+        """Return the JSON representation of the list, encoded as string.
+
+        Apart from *items*, *revision* and the summary, the result is cached per user until the list
+        is modified.
+        """
+        key = (self.id, restricted, include, self.app.user.id if self.app.user else None)
+        # pylint: disable=protected-access; Listling is a friend
+        data = self.app._json_cache.get(key)
+        if data is None:
+            with self.app.metrics.phase('json'):
+                obj = self.json(restricted, include)
+                for attr in List._SUMMARY_ATTRS:
+                    obj.pop(attr, None)
+                data = json.dumps(obj)
+            self.app._json_cache.set(key, data, _json_dependencies(self))
+        if restricted:
+            data = '{}, {}}}'.format(data[:-1], json.dumps(self._summary())[1:-1])
+        return data
+
+    def _summary(self):
+        # Dynamic attributes of the list, fetched in a single round-trip
+        return _summaries(self.app.r, [self])[0]
+
     def _check_permission(self, user, op):
         permissions = List._PERMISSIONS[self.mode]
-        if not (user and (
-                op in permissions['user'] or
-                user == self.authors[0] or
-                user in self.app.settings.staff)):
-            raise PermissionError()
+        with self.app.metrics.phase('permission'):
+            if not (user and (
+                    op in permissions['user'] or
+                    user == self.authors[0] or
+                    user in self.app.settings.staff)):
+                raise PermissionError()
 
 class Item(Object, Editable, Trashable, WithContent):
     """See :ref:`Item`."""
@@ -429,24 +1567,33 @@ class Item(Object, Editable, Trashable, WithContent):
         return self.app.lists[self._list_id]
 
     def delete(self):
-        self.app.r.lrem(self.list.items.ids.key, 1, self.id.encode())
-        self.app.r.delete(self.id)
+        with self.app.transaction() as r:
+            r.zrem('{}.items'.format(self._list_id), self.id.encode())
+            r.zrem(_trash_key(self._list_id), self.id.encode())
+            r.zrem('micro_trash', self.id.encode())
+            r.delete(self.id)
+            # pylint: disable=protected-access; Listling is a friend
+            self.app._touch(r, self._list_id, self.id, 'absent')
+            self.app._index(r, _item_index_prefix(self._list_id), self.id, [])
+            self.app._index_location(r, self._list_id, self.id, None)
 
     def check(self):
         """See :http:post:`/api/lists/(list-id)/items/(id)/check`."""
         _check_feature(self.app.user, 'check', self)
         self._check_permission(self.app.user, 'item-modify')
         self.checked = True
-        self.app.r.oset(self.id, self)
-        self.list.activity.publish(Event.create('item-check', self, app=self.app))
+        with self.app.transaction() as r:
+            r.oset(self.id, self)
+            self.list.activity.publish(Event.create('item-check', self, app=self.app))
 
     def uncheck(self):
         """See :http:post:`/api/lists/(list-id)/items/(id)/uncheck`."""
         _check_feature(self.app.user, 'check', self)
         self._check_permission(self.app.user, 'item-modify')
         self.checked = False
-        self.app.r.oset(self.id, self)
-        self.list.activity.publish(Event.create('item-uncheck', self, app=self.app))
+        with self.app.transaction() as r:
+            r.oset(self.id, self)
+            self.list.activity.publish(Event.create('item-uncheck', self, app=self.app))
 
     async def do_edit(self, **attrs):
         self._check_permission(self.app.user, 'item-modify')
@@ -461,12 +1608,32 @@ class Item(Object, Editable, Trashable, WithContent):
             self.location = attrs['location']
 
     def trash(self):
+        # Like Trashable.trash(), but with all writes within the transaction
         self._check_permission(self.app.user, 'item-modify')
-        super().trash()
+        if self.trashed:
+            return
+        with self.app.transaction() as r:
+            self.trashed = True
+            r.oset(self.id, self)
+            r.zadd('micro_trash', {
+                self.id.encode(): (datetime.now(timezone.utc) + Trashable.RETENTION).timestamp()
+            })
+            self.list.activity.publish(Event.create('trashable-trash', self, app=self.app))
+            # pylint: disable=protected-access; Items is a friend
+            self.list.items._index_trashed(r, self)
 
     def restore(self):
+        # Like Trashable.restore(), but with all writes within the transaction
         self._check_permission(self.app.user, 'item-modify')
-        super().restore()
+        if not self.trashed:
+            return
+        with self.app.transaction() as r:
+            self.trashed = False
+            r.oset(self.id, self)
+            r.zrem('micro_trash', self.id.encode())
+            self.list.activity.publish(Event.create('trashable-restore', self, app=self.app))
+            # pylint: disable=protected-access; Items is a friend
+            self.list.items._index_trashed(r, self)
 
     def json(self, restricted=False, include=False):
         return {
@@ -480,15 +1647,589 @@ class Item(Object, Editable, Trashable, WithContent):
             'checked': self.checked
         }
 
+    def encoded_json(self, restricted=False, include=False):
+        """Return the JSON representation of the item, encoded as string.
+
+        The result is cached until the item or one of its authors is modified.
+        """
+        user = self.app.user
+        # Authors see their own private attributes
+        key = (self.id, restricted, include,
+               user.id if include and user and user.id in self._authors else None)
+        # pylint: disable=protected-access; Listling is a friend
+        data = self.app._json_cache.get(key)
+        if data is None:
+            with self.app.metrics.phase('json'):
+                data = json.dumps(self.json(restricted, include))
+            self.app._json_cache.set(key, data, _json_dependencies(self))
+        return data
+
     def _check_permission(self, user, op):
-        lst = self.list
-        # pylint: disable=protected-access; List is a friend
-        permissions = List._PERMISSIONS[lst.mode]
-        if not (user and (
-                op in permissions['user'] or
-                user == lst.authors[0] or
-                user in self.app.settings.staff)):
-            raise PermissionError()
+        with self.app.metrics.phase('permission'):
+            lst = self.list
+            # pylint: disable=protected-access; List is a friend
+            permissions = List._PERMISSIONS[lst.mode]
+            if not (user and (
+                    op in permissions['user'] or
+                    user == lst.authors[0] or
+                    user in self.app.settings.staff)):
+                raise PermissionError()
+
+class ItemView:
+    """Lightweight, read-only view of an :class:`Item` for bulk reads.
+
+    Attributes of the item are decoded from its stored fields on access, e.g. ``view.title``.
+
+    .. attribute:: id
+
+       Item ID.
+
+    .. attribute:: app
+
+       Context application.
+    """
+
+    __slots__ = ('id', 'app', '_fields', '_users')
+
+    def __init__(self, id, app, fields, users=None):
+        self.id = id
+        self.app = app
+        self._fields = fields
+        self._users = {} if users is None else users
+
+    def __getattr__(self, name):
+        try:
+            data = self._fields[name]
+        except KeyError:
+            raise AttributeError(name)
+        value = json.loads(data, object_hook=self.app.r.decode)
+        if name == 'location' and value:
+            value = Location.parse(value)
+        return value
+
+    def item(self):
+        """Return the full :class:`Item`."""
+        return self.app.r.oget(self.id)
+
+    def encoded_json(self, restricted=False, include=False):
+        """Return the JSON representation of the item, encoded as string.
+
+        The result equals the one of :meth:`Item.encoded_json`, but only *authors* are decoded, if
+        *include* is set.
+        """
+        with self.app.metrics.phase('json'):
+            fields = self._fields
+            if include:
+                authors = [self._author_json(id, restricted)
+                           for id in json.loads(fields['authors'])]
+                fields = dict(fields, authors='[{}]'.format(', '.join(authors)))
+            return _join_fields(fields)
+
+    def _author_json(self, id, restricted):
+        # Authors are shared by many items, so their JSON is memoized for the view batch
+        key = (id, restricted)
+        data = self._users.get(key)
+        if data is None:
+            data = json.dumps(self.app.users[id].json(restricted))
+            self._users[key] = data
+        return data
+
+class _JSONRedis(JSONRedis):
+    # JSONRedis which reports every object written via on_set(r, key, object, fields), where r is
+    # the client to use for any accompanying writes and fields are the names of the modified
+    # attributes, if known.
+    #
+    # Objects with a key in _HASH_PREFIXES are stored as hashes. The stored fields of an object are
+    # remembered when it is read, so that only modified attributes are written.
+
+    def __init__(self, r, encode=None, decode=None, caching=True, *, on_set):
+        self._local = local()
+        super().__init__(r, encode, decode, caching)
+        self.on_set = on_set
+        self.fields = WeakKeyDictionary()
+        # Keys of cached objects written and functions deferred by the pipeline, if any
+        self.written = set()
+        self._deferred = []
+
+    @property
+    def unit(self):
+        # Pipeline of the current transaction of the calling thread, if any, buffering all writes
+        return getattr(self._local, 'unit', None)
+
+    @unit.setter
+    def unit(self, value):
+        self._local.unit = value
+
+    def oget(self, key, default=None, expect=None):
+        object = self._cache.get(key) if self.caching else None
+        if object is None:
+            object = _fetch(self, [key])[0]
+            if object is not None and self.caching:
+                self._cache[key] = object
+        if object is None:
+            if isinstance(default, type) and issubclass(default, Exception):
+                raise default(key)
+            object = default
+        return expect(object) if expect and object is not None else object
+
+    def oset(self, key, object):
+        # Apply the object and the accompanying writes at once
+        r = self.unit if self.unit is not None else self.multi()
+        if self.caching:
+            self._cache[key] = object
+            r.written.add(key)
+        if key.startswith(_HASH_PREFIXES):
+            fields = {name: json.dumps(value, default=self.encode)
+                      for name, value in self.encode(object).items()}
+            stored = self.fields.get(object)
+            if stored is None:
+                r.delete(key)
+                r.hset(key, mapping=fields)
+                modified = None
+            else:
+                changed = {name: value for name, value in fields.items()
+                           if stored.get(name) != value}
+                removed = stored.keys() - fields.keys()
+                if removed:
+                    r.hdel(key, *removed)
+                if changed:
+                    r.hset(key, mapping=changed)
+                modified = changed.keys() | removed
+            # Remember the stored fields only once they are written
+            r.defer(partial(self.fields.__setitem__, object, fields))
+            self.on_set(r, key, object, modified)
+        else:
+            r.set(key, json.dumps(object, default=self.encode))
+            self.on_set(r, key, object)
+        if r is not self.unit:
+            r.execute()
+
+    def multi(self):
+        # JSONRedis interface to a MULTI/EXEC pipeline, sharing the object cache. Commands are
+        # buffered and sent in a single round-trip on execute().
+        r = _JSONRedis(self.r.pipeline(), self.encode, self.decode, self.caching,
+                       on_set=self.on_set)
+        # pylint: disable=protected-access; same class
+        r._cache = self._cache
+        r.fields = self.fields
+        r.unit = r
+        return r
+
+    def defer(self, func):
+        # Call func() once the writes of the pipeline are applied
+        self._deferred.append(func)
+
+    def execute(self):
+        # Apply the writes of the pipeline and call the deferred functions
+        results = self.r.execute()
+        deferred = self._deferred
+        self.written = set()
+        self._deferred = []
+        for func in deferred:
+            func()
+        return results
+
+    def discard(self):
+        # Discard the writes of the pipeline, including written objects in the cache
+        for key in self.written:
+            self.uncache(key)
+        self.written = set()
+        self._deferred = []
+        self.r.reset()
+
+    def __getattr__(self, name):
+        if self.unit is not None and name in _WRITE_COMMANDS:
+            return getattr(self.unit.r, name)
+        return super().__getattr__(name)
+
+    def uncache(self, key):
+        # Drop the object at key from the object cache, e.g. if it was modified by another process
+        self._cache.pop(key, None)
+
+class _EventRelay:
+    # Relay of list events from Redis pub/sub to the live streams of this process. There is a
+    # single subscription per list, shared by all of its streams, and a single connection, which is
+    # read by a background thread. Other messages can be received with listen().
+
+    class Stream(Activity.Stream):
+        # Activity stream which releases the subscription of the list when the last stream is
+        # closed
+
+        def __init__(self, relay, list_id, streams):
+            super().__init__(streams)
+            self._relay = relay
+            self._list_id = list_id
+
+        async def aclose(self):
+            await super().aclose()
+            # pylint: disable=protected-access; _EventRelay is a friend
+            self._relay._release(self._list_id, self._streams)
+
+    def __init__(self, app):
+        self.app = app
+        self._streams = {}
+        self._pubsub = None
+        self._thread = None
+        self._loop = None
+
+    def stream(self, list_id):
+        streams = self._streams.get(list_id)
+        if streams is None:
+            streams = self._streams[list_id] = set()
+            self.listen(_events_channel(list_id), partial(self._dispatch, list_id))
+        return _EventRelay.Stream(self, list_id, streams)
+
+    def listen(self, channel, callback):
+        # Call callback(data) on the event loop for every message published on channel
+        def _on_message(message):
+            # Called from the background thread
+            self._loop.call_soon_threadsafe(callback, message['data'].decode())
+        if self._pubsub:
+            self._pubsub.subscribe(**{channel: _on_message})
+        else:
+            self._loop = get_event_loop()
+            self._pubsub = self.app.r.r.pubsub(ignore_subscribe_messages=True)
+            self._pubsub.subscribe(**{channel: _on_message})
+            self._thread = self._pubsub.run_in_thread(sleep_time=1, daemon=True)
+
+    async def close(self):
+        # Stop the background thread and close the connection. Subsequent listen() calls start
+        # over.
+        if not self._pubsub:
+            return
+        pubsub, thread = self._pubsub, self._thread
+        self._pubsub = None
+        self._thread = None
+        self._streams.clear()
+        thread.stop()
+        # The thread notices within sleep_time, so wait for it without blocking the event loop
+        await get_event_loop().run_in_executor(None, thread.join)
+        pubsub.close()
+
+    def unlisten(self, channel):
+        # Stop receiving messages published on channel
+        if self._pubsub:
+            self._pubsub.unsubscribe(channel)
+
+    def _release(self, list_id, streams):
+        if not streams and self._streams.get(list_id) is streams:
+            del self._streams[list_id]
+            self._pubsub.unsubscribe(_events_channel(list_id))
+
+    def _dispatch(self, list_id, event_id):
+        streams = self._streams.get(list_id)
+        if not streams:
+            return
+        # The event is only loaded once for all streams
+        event = self.app.r.oget(event_id)
+        if event:
+            for queue in streams:
+                queue.put_nowait(event)
+
+class _JobQueue:
+    # Queue of background jobs, shared by all processes via the Redis sorted set jobs, scored by
+    # the time a job is due. A job is performed by the handler registered for its name with its
+    # JSON arguments. Failed jobs are retried with exponential backoff. If the queue is full, jobs
+    # are performed by the producing process instead, at most _JOB_LOCAL_LIMIT at a time, and
+    # dropped beyond that, so that both the queue and the local jobs stay bounded.
+    #
+    # There is a single consumer per process, which is woken up by keyspace notifications of the
+    # queue, received via the event relay, instead of polling.
+
+    def __init__(self, app, handlers):
+        self.app = app
+        self.handlers = handlers
+        self._local_jobs = 0
+
+    def enqueue(self, name, *args, attempt=0, delay=0):
+        job = json.dumps({'id': randstr(), 'name': name, 'args': args, 'attempt': attempt})
+        if self.app.r.r.zcard('jobs') >= _JOB_QUEUE_LIMIT:
+            if self._local_jobs >= _JOB_LOCAL_LIMIT:
+                _LOGGER.error('Job queue full, dropping %s job', name)
+                return
+            _LOGGER.warning('Job queue full, performing %s job locally', name)
+            self._local_jobs += 1
+            ensure_future(self._perform_local(job))
+            return
+        # Within a transaction, the job is enqueued together with its data
+        self.app.r.zadd('jobs', {job: time() + delay})
+
+    async def work(self, workers):
+        # Pop and perform due jobs, at most workers at a time
+        loop = get_event_loop()
+        semaphore = Semaphore(workers)
+        tasks = set()
+        wakeup = loop.create_future()
+        def _on_notification(_):
+            if not wakeup.done():
+                wakeup.set_result(None)
+        def _on_done(task):
+            tasks.discard(task)
+            semaphore.release()
+
+        r = self.app.r.r
+        flags = set(r.config_get()['notify-keyspace-events']) | set('Kz')
+        r.config_set('notify-keyspace-events', ''.join(flags))
+        channel = '__keyspace@{}__:jobs'.format(r.connection_pool.connection_kwargs['db'])
+        # pylint: disable=protected-access; Listling is a friend
+        self.app._event_relay.listen(channel, _on_notification)
+
+        try:
+            while True:
+                await semaphore.acquire()
+                # Reset before popping, so that a job enqueued in the meantime is not missed
+                if wakeup.done():
+                    wakeup = loop.create_future()
+                result = zpoptimed(r, 'jobs')
+                if isinstance(result, tuple):
+                    task = ensure_future(self._perform(result[0].decode()))
+                    tasks.add(task)
+                    task.add_done_callback(_on_done)
+                    continue
+                semaphore.release()
+                await wait([wakeup], timeout=min(max(result - time(), 0), _JOB_POLL_INTERVAL))
+        finally:
+            self.app._event_relay.unlisten(channel)
+            for task in tasks:
+                task.cancel()
+            # Retrieve the results of the jobs
+            await gather(*tasks, return_exceptions=True)
+
+    async def _perform_local(self, job):
+        try:
+            await self._perform(job)
+        finally:
+            self._local_jobs -= 1
+
+    async def _perform(self, job):
+        job = json.loads(job)
+        # pylint: disable=broad-except; retry on any error
+        try:
+            await self.handlers[job['name']](*job['args'])
+        except Exception as e:
+            attempt = job['attempt'] + 1
+            if attempt == _JOB_ATTEMPTS:
+                _LOGGER.error('Failed to perform %s job', job['name'], exc_info=e)
+                return
+            _LOGGER.warning('Failed to perform %s job, retrying: %s', job['name'], e)
+            self.enqueue(job['name'], *job['args'], attempt=attempt, delay=10 * 2 ** attempt)
+
+class _ResourceAnalyzer(Analyzer):
+    # Analyzer which shares its results via Redis, so a resource is only fetched once by all
+    # processes. Analysis failures are cached as well, but for a shorter time. Communication errors
+    # are not, as they are likely temporary.
+
+    _CACHE_SIZE = 1024
+    _ERRORS = {e.__name__: e for e in [NoResourceError, ForbiddenResourceError,
+                                       BrokenResourceError]}
+
+    def __init__(self, app, *, handlers):
+        super().__init__(handlers=handlers)
+        self.app = app
+
+    async def analyze(self, url):
+        try:
+            resource = self._get_cache(url)
+            self.app.metrics.count_cache('resource', True)
+            return resource
+        except KeyError:
+            pass
+
+        key = 'resource_cache:{}'.format(url)
+        data = self.app.r.r.get(key)
+        self.app.metrics.count_cache('resource', data is not None)
+        if data is not None:
+            result = json.loads(data.decode(), object_hook=self.app.r.decode)
+            if isinstance(result, dict):
+                raise self._ERRORS[result['error']](result['message'])
+            self._set_cache(url, result)
+            return result
+
+        try:
+            resource = await super().analyze(url)
+        except tuple(self._ERRORS.values()) as e:
+            self.app.r.r.set(key, json.dumps({'error': type(e).__name__, 'message': str(e)}),
+                             ex=_RESOURCE_ERROR_CACHE_TTL)
+            raise
+        self.app.r.r.set(key, json.dumps(resource, default=self.app.r.encode),
+                         ex=_RESOURCE_CACHE_TTL)
+        return resource
+
+class _JSONCache:
+    # Least recently used cache of encoded JSON representations. Each entry depends on a set of
+    # object IDs and is invalidated as soon as one of these objects changes.
+
+    def __init__(self, size, metrics):
+        self.size = size
+        self.metrics = metrics
+        self._entries = OrderedDict()
+        self._dependents = {}
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        self.metrics.count_cache('json', entry is not None)
+        if entry is None:
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def set(self, key, data, dependencies):
+        self._remove(key)
+        self._entries[key] = (dependencies, data)
+        for id in dependencies:
+            self._dependents.setdefault(id, set()).add(key)
+        if len(self._entries) > self.size:
+            self._remove(next(iter(self._entries)))
+
+    def invalidate(self, id):
+        for key in self._dependents.get(id, set()).copy():
+            self._remove(key)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry:
+            for id in entry[0]:
+                keys = self._dependents[id]
+                keys.discard(key)
+                if not keys:
+                    del self._dependents[id]
+
+def _json_dependencies(obj):
+    # The JSON of obj embeds its authors, including the count of their lists
+    # pylint: disable=protected-access; Editable is a friend
+    return {obj.id, *obj._authors, *('{}.lists'.format(id) for id in obj._authors)}
+
+def _events_channel(list_id):
+    return '{}.events'.format(list_id)
+
+def _geo_key(list_id):
+    return '{}.items.geo'.format(list_id)
+
+def _check_coords(coords):
+    lat, lng = coords
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        raise micro.ValueError('out_of_range_coords')
+    return lat, lng
+
+def _clamp_lat(lat):
+    # Redis GEO commands do not support latitudes close to the poles
+    return max(-_GEO_LAT_LIMIT, min(lat, _GEO_LAT_LIMIT))
+
+def _distance(a, b):
+    # Great-circle distance in meters between the coordinates a and b, like Redis GEODIST
+    lat1, lng1, lat2, lng2 = map(radians, (*a, *b))
+    h = sin((lat2 - lat1) / 2) ** 2 + cos(lat1) * cos(lat2) * sin((lng2 - lng1) / 2) ** 2
+    return 2 * _EARTH_RADIUS * asin(min(sqrt(h), 1))
+
+def _item_index_prefix(list_id):
+    return '{}.items.search.'.format(list_id)
+
+def _terms(*texts):
+    # Search terms of the given texts, which may be None
+    return {term.lower() for text in texts if text for term in _TERM_PATTERN.findall(text)}
+
+def _revision_key(list_id):
+    return '{}.revision'.format(list_id)
+
+def _summary_keys(list_id):
+    return {
+        'items': '{}.items.present'.format(list_id),
+        'checked': '{}.items.checked'.format(list_id),
+        'modify_time': '{}.modify_time'.format(list_id)
+    }
+
+def _summaries(r, lists):
+    # Fetch the dynamic attributes of all lists in a single round-trip
+    if not lists:
+        return []
+    p = r.pipeline()
+    for lst in lists:
+        keys = _summary_keys(lst.id)
+        p.zcard(lst.items.ids.key)
+        p.get(_revision_key(lst.id))
+        p.scard(keys['items'])
+        p.scard(keys['checked'])
+        p.get(keys['modify_time'])
+    results = p.execute()
+    return [
+        {
+            'items': {'count': count},
+            'revision': int(revision or 0),
+            'item_count': item_count,
+            'checked_item_count': checked_item_count,
+            'modify_time':
+                datetime.utcfromtimestamp(float(modify_time)).isoformat() + 'Z'
+                if modify_time else None
+        }
+        for count, revision, item_count, checked_item_count, modify_time
+        in zip(*[iter(results)] * 5)
+    ]
+
+def _sequence_key(activity_id):
+    return '{}.sequence'.format(activity_id)
+
+def _trash_key(list_id):
+    return '{}.items.trashed'.format(list_id)
+
+def _item_state(item):
+    if item.trashed:
+        return 'absent'
+    return 'checked' if item.checked else 'present'
+
+def _mget(r, ids):
+    # Unlike JSONRedis.omget(), fetch all objects in a single round-trip. Objects which vanished in
+    # the meantime are skipped.
+    return [obj for obj in _fetch(r, ids) if obj is not None]
+
+def _fetch(r, keys):
+    # Fetch the objects at keys, stored as JSON strings or hashes, in a single round-trip. Missing
+    # objects are None.
+    objects = []
+    for value in _fetch_raw(r, keys):
+        if isinstance(value, dict):
+            obj = json.loads(_join_fields(value), object_hook=r.decode)
+            if isinstance(r, _JSONRedis) and isinstance(obj, Object):
+                r.fields[obj] = value
+        else:
+            obj = json.loads(value, object_hook=r.decode) if value is not None else None
+        objects.append(obj)
+    return objects
+
+def _fetch_fields(r, keys):
+    # Like _fetch(), but return the encoded fields of the objects, without decoding them
+    fields = []
+    for value in _fetch_raw(r, keys):
+        if isinstance(value, str):
+            value = {name: json.dumps(data) for name, data in json.loads(value).items()}
+        fields.append(value)
+    return fields
+
+def _fetch_raw(r, keys):
+    # Fetch the values at keys in a single round-trip. Strings are returned as str, hashes as dict.
+    pool = r.r.connection_pool
+    if pool not in _MGET_CACHE:
+        _MGET_CACHE[pool] = r.r.register_script(_MGET_SCRIPT)
+    values = _MGET_CACHE[pool](keys=keys, client=r.r)
+    return [
+        {name.decode(): data.decode() for name, data in zip(value[::2], value[1::2])}
+        if isinstance(value, list) else value.decode() if value is not None else None
+        for value in values
+    ]
+
+def _join_fields(fields):
+    # Encode the object with the encoded fields
+    return '{{{}}}'.format(', '.join('{}: {}'.format(json.dumps(name), data)
+                                     for name, data in fields.items()))
+
+def _scan(r, key):
+    # Iterate over the Redis list at key, fetching it batch by batch
+    start = 0
+    while True:
+        ids = r.lrange(key, start, start + _UPDATE_BATCH_SIZE - 1)
+        yield from ids
+        if len(ids) < _UPDATE_BATCH_SIZE:
+            break
+        start += _UPDATE_BATCH_SIZE
 
 def _check_feature(user, feature, item):
     if feature not in item.list.features:
@@ -0,0 +1,297 @@
+# Open Listling
+# Copyright (C) 2018 Open Listling contributors
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of the GNU
+# Affero General Public License as published by the Free Software Foundation, either version 3 of
+# the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along with this program.
+# If not, see <https://www.gnu.org/licenses/>.
+
+"""Performance metrics."""
+
+from contextlib import contextmanager
+from time import perf_counter
+
+try:
+    from contextvars import ContextVar
+except ImportError:
+    # Compatibility for Python < 3.7, where the record is shared by all requests
+    class ContextVar: # type: ignore
+        # pylint: disable=missing-docstring; stand-in
+        def __init__(self, name, *, default=None):
+            # pylint: disable=unused-argument; part of API
+            self._value = default
+
+        def get(self):
+            return self._value
+
+        def set(self, value):
+            self._value = value
+
+_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+
+class Metrics:
+    """Performance metrics of the app, collected per endpoint.
+
+    Redis round-trips and the time spent in *phases* of a request, like JSON encoding, are recorded
+    in the :class:`Record` of the current request (or task). Metrics are collected per process and
+    can be combined with the ones of other processes via :meth:`json`.
+
+    .. attribute:: requests
+
+       Latency :class:`Histogram` per ``(endpoint, method)``.
+
+    .. attribute:: records
+
+       Sum of all :class:`Record` s of the requests per ``(endpoint, method)``.
+
+    .. attribute:: caches
+
+       Number of lookups per cache, as list ``[hits, misses]``.
+    """
+
+    class Record:
+        """Breakdown of a request.
+
+        .. attribute:: redis_roundtrips
+
+           Number of round-trips to Redis.
+
+        .. attribute:: redis_commands
+
+           Number of Redis commands.
+
+        .. attribute:: redis_time
+
+           Time spent waiting for Redis in seconds.
+
+        .. attribute:: phases
+
+           Time spent in the phases of the request in seconds, by name. Phases may include Redis
+           time.
+        """
+
+        def __init__(self):
+            self.redis_roundtrips = 0
+            self.redis_commands = 0
+            self.redis_time = 0.0
+            self.phases = {}
+
+        def add(self, other):
+            """Add the values of the *other* record."""
+            self.redis_roundtrips += other.redis_roundtrips
+            self.redis_commands += other.redis_commands
+            self.redis_time += other.redis_time
+            for phase, t in other.phases.items():
+                self.phases[phase] = self.phases.get(phase, 0.0) + t
+
+        def json(self):
+            """Return a JSON representation of the record."""
+            return {
+                'redis_roundtrips': self.redis_roundtrips,
+                'redis_commands': self.redis_commands,
+                'redis_time': self.redis_time,
+                'phases': dict(self.phases)
+            }
+
+    def __init__(self):
+        self.requests = {}
+        self.records = {}
+        self.caches = {}
+        self._record = ContextVar('record', default=None)
+
+    @property
+    def record(self):
+        """:class:`Record` of the current request (or task)."""
+        record = self._record.get()
+        if record is None:
+            record = Metrics.Record()
+            self._record.set(record)
+        return record
+
+    def reset_record(self):
+        """Finish the :attr:`record` of the current request and return it."""
+        record = self.record
+        self._record.set(None)
+        return record
+
+    def bind(self, func):
+        """Return a wrapper of *func* recording in the current :attr:`record`.
+
+        Used to call *func* from another thread.
+        """
+        record = self.record
+        def _wrapper(*args, **kwargs):
+            self._record.set(record)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._record.set(None)
+        return _wrapper
+
+    @contextmanager
+    def phase(self, name):
+        """Context manager which records the time spent in the block as phase *name*."""
+        t = perf_counter()
+        try:
+            yield
+        finally:
+            phases = self.record.phases
+            phases[name] = phases.get(name, 0.0) + perf_counter() - t
+
+    def count_cache(self, name, hit):
+        """Count a lookup of the cache *name*, which was a *hit* or not."""
+        lookups = self.caches.setdefault(name, [0, 0])
+        lookups[0 if hit else 1] += 1
+
+    def count_request(self, endpoint, method, duration, record):
+        """Count a request of *method* to *endpoint*, which took *duration* seconds.
+
+        *record* is the breakdown of the request.
+        """
+        key = (endpoint, method)
+        histogram = self.requests.get(key)
+        if histogram is None:
+            histogram = self.requests[key] = Histogram()
+            self.records[key] = Metrics.Record()
+        histogram.observe(duration)
+        self.records[key].add(record)
+
+    def json(self):
+        """Return a JSON representation of the metrics, e.g. to share them with other processes."""
+        return {
+            'requests': [
+                {'endpoint': endpoint, 'method': method, 'counts': list(histogram.counts),
+                 'sum': histogram.sum, 'record': self.records[(endpoint, method)].json()}
+                for (endpoint, method), histogram in sorted(self.requests.items())
+            ],
+            'caches': {name: list(lookups) for name, lookups in self.caches.items()}
+        }
+
+    def export(self, workers=None):
+        """Return the metrics in the Prometheus text exposition format.
+
+        If the app is run by multiple processes, *workers* are the metrics of all of them in their
+        :meth:`json` form by worker ID, which are exported with a *worker* label instead.
+        """
+        if workers is None:
+            workers = {None: self.json()}
+        metrics = [('worker="{}",'.format(_escape(str(worker))) if worker is not None else '', obj)
+                   for worker, obj in sorted(workers.items(), key=lambda item: str(item[0]))]
+
+        lines = [
+            '# HELP listling_request_duration_seconds Latency of requests.',
+            '# TYPE listling_request_duration_seconds histogram'
+        ]
+        for worker, obj in metrics:
+            for request in obj['requests']:
+                labels = '{}endpoint="{}",method="{}"'.format(
+                    worker, _escape(request['endpoint']), request['method'])
+                for bound, count in zip(_BUCKETS, request['counts']):
+                    lines.append('listling_request_duration_seconds_bucket{{{},le="{}"}} {}'.format(
+                        labels, '+Inf' if bound == float('inf') else bound, count))
+                lines.append('listling_request_duration_seconds_sum{{{}}} {}'.format(
+                    labels, request['sum']))
+                lines.append('listling_request_duration_seconds_count{{{}}} {}'.format(
+                    labels, request['counts'][-1]))
+
+        counters = [
+            ('listling_redis_roundtrips_total', 'Round-trips to Redis.', 'redis_roundtrips'),
+            ('listling_redis_commands_total', 'Redis commands.', 'redis_commands'),
+            ('listling_redis_duration_seconds_total', 'Time spent waiting for Redis.',
+             'redis_time')
+        ]
+        for name, description, attr in counters:
+            lines += ['# HELP {} {}'.format(name, description), '# TYPE {} counter'.format(name)]
+            for worker, obj in metrics:
+                for request in obj['requests']:
+                    lines.append('{}{{{}endpoint="{}",method="{}"}} {}'.format(
+                        name, worker, _escape(request['endpoint']), request['method'],
+                        request['record'][attr]))
+
+        lines += ['# HELP listling_phase_duration_seconds_total Time spent in request phases.',
+                  '# TYPE listling_phase_duration_seconds_total counter']
+        for worker, obj in metrics:
+            for request in obj['requests']:
+                for phase, t in sorted(request['record']['phases'].items()):
+                    lines.append(
+                        'listling_phase_duration_seconds_total'
+                        '{{{}endpoint="{}",method="{}",phase="{}"}} {}'.format(
+                            worker, _escape(request['endpoint']), request['method'], phase, t))
+
+        lines += ['# HELP listling_cache_lookups_total Cache lookups.',
+                  '# TYPE listling_cache_lookups_total counter']
+        for worker, obj in metrics:
+            for name, (hits, misses) in sorted(obj['caches'].items()):
+                lines.append('listling_cache_lookups_total{{{}cache="{}",result="hit"}} {}'.format(
+                    worker, name, hits))
+                lines.append(
+                    'listling_cache_lookups_total{{{}cache="{}",result="miss"}} {}'.format(
+                        worker, name, misses))
+        return '\n'.join(lines) + '\n'
+
+class Histogram:
+    """Cumulative histogram of observed values.
+
+    .. attribute:: counts
+
+       Number of values less than or equal to the bound of each bucket.
+
+    .. attribute:: sum
+
+       Sum of all values.
+    """
+
+    def __init__(self):
+        self.counts = [0] * len(_BUCKETS)
+        self.sum = 0.0
+
+    def observe(self, value):
+        """Observe a *value*."""
+        for i, bound in enumerate(_BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+
+def instrument_redis(r, metrics):
+    """Record the round-trips of the Redis client *r* in the :class:`Metrics` *metrics*.
+
+    Must be called before *r* opens its first connection.
+    """
+    pool = r.connection_pool
+    pool.connection_class = type('InstrumentedConnection',
+                                 (_InstrumentedConnection, pool.connection_class),
+                                 {'metrics': metrics})
+
+class _InstrumentedConnection:
+    # Connection mixin which records each command sent and response read
+
+    metrics = None
+
+    def send_packed_command(self, command, *args, **kwargs):
+        # pylint: disable=missing-docstring; already documented
+        t = perf_counter()
+        try:
+            return super().send_packed_command(command, *args, **kwargs)
+        finally:
+            record = self.metrics.record
+            record.redis_roundtrips += 1
+            record.redis_time += perf_counter() - t
+
+    def read_response(self, *args, **kwargs):
+        # pylint: disable=missing-docstring; already documented
+        t = perf_counter()
+        try:
+            return super().read_response(*args, **kwargs)
+        finally:
+            record = self.metrics.record
+            record.redis_commands += 1
+            record.redis_time += perf_counter() - t
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
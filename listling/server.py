@@ -18,53 +18,193 @@
 
 """Open Listling server."""
 
+from asyncio import ensure_future, sleep
+import csv
+import http.client
+from io import StringIO
 import json
+from logging import getLogger
+import re
+from signal import SIGINT, SIG_IGN, signal
 
 import micro
 from micro import Location
-from micro.server import (Endpoint, CollectionEndpoint, Server, UI, make_activity_endpoint,
-                          make_orderable_endpoints, make_trashable_endpoints)
-from micro.util import ON
+from micro.server import (LIST_LIMIT, SLICE_URL, ActivityStreamEndpoint, Endpoint,
+                          CollectionEndpoint, Server, UI, make_orderable_endpoints,
+                          make_trashable_endpoints)
+from micro.util import ON, cancel, parse_slice
+from tornado.netutil import bind_sockets
+from tornado.process import fork_processes
 
 from . import Listling
 
+_LOGGER = getLogger(__name__)
+# Interval in seconds at which worker processes share their metrics
+_METRICS_INTERVAL = 5
+
 def make_server(*, port=8080, url=None, debug=False, redis_url='', smtp_url='',
-                video_service_keys={}, client_map_service_key=None):
-    """Create an Open Listling server."""
-    app = Listling(redis_url, smtp_url=smtp_url, video_service_keys=video_service_keys)
+                video_service_keys={}, client_map_service_key=None, workers=1,
+                slow_request_threshold=None, trash_retention=None, activity_max_events=None,
+                activity_max_age=None):
+    """Create an Open Listling server.
+
+    If the number of *workers* is greater than one, the server is run by as many processes, sharing
+    the listening socket. Requests which take at least *slow_request_threshold* seconds are logged
+    with a breakdown. Trashed items are permanently deleted after *trash_retention*, see
+    :attr:`Listling.trash_retention`. The retention policy of activities is given by
+    *activity_max_events* and *activity_max_age*, see :attr:`Listling.activity_max_events` and
+    :attr:`Listling.activity_max_age`.
+    """
+    options = {'trash_retention': trash_retention, 'activity_max_events': activity_max_events,
+               'activity_max_age': activity_max_age}
+    app = Listling(redis_url, smtp_url=smtp_url, video_service_keys=video_service_keys,
+                   **{key: value for key, value in options.items() if value is not None})
     handlers = [
         # API
         (r'/api/users/([^/]+)/lists$', _UserListsEndpoint),
+        (r'/api/users/([^/]+)/lists/search$', _UserListsSearchEndpoint),
         (r'/api/users/([^/]+)/lists/([^/]+)$', _UserListEndpoint),
         (r'/api/lists$', _ListsEndpoint),
         (r'/api/lists/create-example$', _ListsCreateExampleEndpoint),
+        (r'/api/lists/import$', _ListsImportEndpoint),
         (r'/api/lists/([^/]+)$', _ListEndpoint),
+        (r'/api/lists/([^/]+)/changes$', _ListChangesEndpoint),
         (r'/api/lists/([^/]+)/items$', _ListItemsEndpoint),
         *make_orderable_endpoints(r'/api/lists/([^/]+)/items', lambda id: app.lists[id].items),
-        make_activity_endpoint(r'/api/lists/([^/]+)/activity',
-                               lambda id, *a: app.lists[id].activity),
+        (r'/api/lists/([^/]+)/activity{}$'.format(SLICE_URL), _ListActivityEndpoint),
+        # Relay events of all processes, instead of only the local ones of the activity
+        (r'/api/lists/([^/]+)/activity/stream$', ActivityStreamEndpoint,
+         {'get_activity': lambda id: app.lists[id]}),
+        (r'/api/lists/([^/]+)/items/batch$', _ListItemsBatchEndpoint),
+        (r'/api/lists/([^/]+)/items/search$', _ListItemsSearchEndpoint),
         (r'/api/lists/([^/]+)/items/([^/]+)$', _ItemEndpoint),
         *make_trashable_endpoints(r'/api/lists/([^/]+)/items/([^/]+)',
                                   lambda list_id, id: app.lists[list_id].items[id]),
         (r'/api/lists/([^/]+)/items/([^/]+)/check$', _ItemCheckEndpoint),
         (r'/api/lists/([^/]+)/items/([^/]+)/uncheck$', _ItemUncheckEndpoint),
+        (r'/metrics$', _MetricsEndpoint),
         # UI
         (r'/lists/([^/]+)(?:/[^/]+)?$', _ListPage)
     ]
-    return Server(app, handlers, port=port, url=url, debug=debug, client_config={
+    return _Server(app, handlers, port=port, url=url, debug=debug, client_config={
         'modules_path': 'node_modules',
         'service_path': 'listling/service.js',
         'shell': ['listling.css', 'listling', 'images'],
         'map_service_key': client_map_service_key,
         'description': 'Service to make and edit lists collaboratively. Free, simple and no registration required.',
         'color': '#4d8dd9'
-    })
+    }, workers=workers, slow_request_threshold=slow_request_threshold)
+
+class _Server(Server):
+    # Server which runs the background job workers of the app, optionally with multiple worker
+    # processes, and collects request metrics. Worker processes share their metrics via Redis, so
+    # that any of them can export the metrics of all.
+
+    def __init__(self, *args, workers=1, slow_request_threshold=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.workers = workers
+        self.slow_request_threshold = slow_request_threshold
+        self._jobs_task = None
+        self._share_metrics_task = None
+        self._sockets = None
+        self._worker = None
+
+        # Endpoints are identified by the URL pattern of their handler
+        self._routes = [(re.compile(handler[0].rstrip('$') + '$'), handler[0].rstrip('$'))
+                        for handler in self.handlers]
+        application = self._server.request_callback
+        log_request = application.log_request
+        def _log_request(handler):
+            self._count_request(handler)
+            log_request(handler)
+        application.log_request = _log_request
+
+    def run(self):
+        if self.workers > 1:
+            # Update the database and bind the socket once before forking. Redis connections are
+            # not shared, because the connection pool resets itself in a forked process.
+            self.app.update()
+            self.app.r.r.delete('metrics')
+            self._sockets = bind_sockets(self.port)
+            # Workers handle SIGINT by stopping gracefully, after which the parent exits as well
+            signal(SIGINT, SIG_IGN)
+            self._worker = fork_processes(self.workers)
+        super().run()
+
+    def start(self):
+        if self._sockets is None:
+            super().start()
+        else:
+            # Only the first worker runs the maintenance tasks of the app
+            if self._worker == 0:
+                self._empty_trash_task = self.app.start_empty_trash()
+                self._collect_statistics_task = self.app.analytics.start_collect_statistics()
+            self._server.add_sockets(self._sockets)
+            self.app.share_caches()
+            self._share_metrics_task = ensure_future(self._share_metrics())
+        self._jobs_task = self.app.start_jobs()
+
+    async def stop(self):
+        await super().stop()
+        if self._jobs_task:
+            await cancel(self._jobs_task)
+        if self._share_metrics_task:
+            await cancel(self._share_metrics_task)
+        # pylint: disable=protected-access; _Server is a friend
+        await self.app._event_relay.close()
+
+    def export_metrics(self):
+        # Export the metrics of all worker processes, see Metrics.export()
+        if self._worker is None:
+            return self.app.metrics.export()
+        self._publish_metrics()
+        workers = self.app.r.r.hgetall('metrics')
+        return self.app.metrics.export(
+            {int(worker): json.loads(data.decode()) for worker, data in workers.items()})
+
+    async def _share_metrics(self):
+        while True:
+            self._publish_metrics()
+            await sleep(_METRICS_INTERVAL)
+
+    def _publish_metrics(self):
+        self.app.r.r.hset('metrics', self._worker, json.dumps(self.app.metrics.json()))
+
+    def _count_request(self, handler):
+        request = handler.request
+        endpoint = next(
+            (name for pattern, name in self._routes if pattern.match(request.path)), request.path)
+        duration = request.request_time()
+        record = self.app.metrics.reset_record()
+        self.app.metrics.count_request(endpoint, request.method, duration, record)
+        if self.slow_request_threshold is not None and duration >= self.slow_request_threshold:
+            _LOGGER.warning(
+                'Slow request %s %s: %.1f ms, Redis %d round-trips (%d commands) %.1f ms%s',
+                request.method, request.uri, duration * 1000, record.redis_roundtrips,
+                record.redis_commands, record.redis_time * 1000,
+                ''.join(', {} {:.1f} ms'.format(phase, t * 1000)
+                        for phase, t in sorted(record.phases.items())))
 
 class _UserListsEndpoint(CollectionEndpoint):
     def initialize(self):
         super().initialize(
             get_collection=lambda id: self.app.users[id].lists.read(user=self.current_user))
 
+    async def get(self, id):
+        cursor = self.get_query_argument('cursor', None)
+        if cursor is None:
+            super().get(id)
+            return
+        limit = _get_limit(self)
+        lists = self.get_collection(id)
+        page, cursor = await lists.page(cursor, limit, asynchronous=ON)
+        self.app.user = self.current_user
+        self.write({
+            'count': len(lists),
+            'items': lists.items_json(page, restricted=True, include=True),
+            'cursor': cursor
+        })
+
     def post(self, id):
         args = self.check_args({'list_id': str})
         list_id = args.pop('list_id')
@@ -76,6 +216,13 @@ class _UserListsEndpoint(CollectionEndpoint):
         lists.add(**args, user=self.current_user)
         self.write({})
 
+class _UserListsSearchEndpoint(Endpoint):
+    async def get(self, id):
+        lists = self.app.users[id].lists.read(user=self.current_user)
+        result = await lists.search(self.get_query_argument('q'), asynchronous=ON)
+        self.app.user = self.current_user
+        self.write(json.dumps(lists.items_json(result, restricted=True, include=True)))
+
 class _UserListEndpoint(Endpoint):
     def delete(self, id, list_id):
         lists = self.app.users[id].lists
@@ -102,11 +249,44 @@ class _ListsCreateExampleEndpoint(Endpoint):
         lst = await self.app.lists.create_example(asynchronous=ON, **args)
         self.write(lst.json(restricted=True, include=True))
 
-class _ListEndpoint(Endpoint):
-    def get(self, id):
-        lst = self.app.lists[id]
+class _ListsImportEndpoint(Endpoint):
+    async def post(self):
+        args = self.check_args({
+            'title': str,
+            'items': (list, str),
+            'description': (str, None, 'opt'),
+            'use_case': (str, 'opt')
+        })
+        if isinstance(args['items'], str):
+            try:
+                args['items'] = [
+                    {
+                        'title': row.get('title'),
+                        'text': row.get('text') or None,
+                        'resource': row.get('resource') or None,
+                        'checked': (row.get('checked') or '').strip().lower() == 'true'
+                    } for row in csv.DictReader(StringIO(args['items']))]
+            except csv.Error:
+                raise micro.ValueError('bad_items_format')
+        for item in args['items']:
+            _check_op(item, 'bad_items_type', create=True)
+            if item.get('location') is not None:
+                try:
+                    item['location'] = Location.parse(item['location'])
+                except TypeError:
+                    raise micro.ValueError('bad_location_type')
+        lst = await self.app.lists.import_(**args)
         self.write(lst.json(restricted=True, include=True))
 
+class _ListEndpoint(Endpoint):
+    async def get(self, id):
+        if _check_not_modified(self, id):
+            return
+        lst = await self.app.lists.fetch(id)
+        self.app.user = self.current_user
+        self.set_header('Content-Type', 'application/json; charset=UTF-8')
+        self.write(lst.encoded_json(restricted=True, include=True))
+
     def post(self, id):
         lst = self.app.lists[id]
         args = self.check_args({
@@ -118,10 +298,102 @@ class _ListEndpoint(Endpoint):
         lst.edit(**args)
         self.write(lst.json(restricted=True, include=True))
 
+class _ListChangesEndpoint(Endpoint):
+    async def get(self, id):
+        try:
+            since = int(self.get_query_argument('since'))
+        except ValueError:
+            raise micro.ValueError('bad_since_type')
+        lst = await self.app.lists.fetch(id)
+        revision, changes = await lst.changes(since, asynchronous=ON)
+        self.app.user = self.current_user
+        self.write({
+            'revision': revision,
+            'changes': [
+                {'id': id, 'item': item.json(restricted=True, include=True) if item else None,
+                 'after_id': after_id}
+                for id, item, after_id in changes]
+        })
+
+class _ListActivityEndpoint(Endpoint):
+    # Activity endpoint as made by make_activity_endpoint(), which additionally supports cursors
+
+    async def get(self, id, slc):
+        activity = (await self.app.lists.fetch(id)).activity
+        cursor = self.get_query_argument('cursor', None)
+        if cursor is None:
+            self.app.user = self.current_user
+            slc = parse_slice(slc or ':', limit=LIST_LIMIT)
+            self.write(activity.json(restricted=True, include=True, slice=slc))
+            return
+        events, cursor = await activity.page(cursor, _get_limit(self), asynchronous=ON)
+        self.app.user = self.current_user
+        self.write({
+            **activity.json(restricted=True, include=True),
+            'items': [event.json(restricted=True, include=True) for event in events],
+            'cursor': cursor
+        })
+
+    def patch_subscribe(self, id, slc):
+        # pylint: disable=unused-argument; part of URL
+        activity = self.app.lists[id].activity
+        activity.subscribe()
+        self.write(activity.json(restricted=True, include=True))
+
+    def patch_unsubscribe(self, id, slc):
+        # pylint: disable=unused-argument; part of URL
+        activity = self.app.lists[id].activity
+        activity.unsubscribe()
+        self.write(activity.json(restricted=True, include=True))
+
 class _ListItemsEndpoint(Endpoint):
-    def get(self, id):
-        lst = self.app.lists[id]
-        self.write(json.dumps([i.json(True, True) for i in lst.items.values()]))
+    async def get(self, id):
+        if _check_not_modified(self, id):
+            return
+        lst = await self.app.lists.fetch(id)
+        self.app.user = self.current_user
+        trashed = self.get_query_argument('trashed', 'false') == 'true'
+        slc = self.get_query_argument('slice', None)
+        bbox = self.get_query_argument('bbox', None)
+        near = self.get_query_argument('near', None)
+        if trashed and (slc is not None or bbox is not None or near is not None):
+            raise micro.ValueError('trashed_filter')
+        if slc is not None:
+            try:
+                slc = parse_slice(slc, limit=LIST_LIMIT)
+            except ValueError:
+                raise micro.ValueError('bad_slice_format')
+            self.write(lst.items.json(restricted=True, include=True, slc=slc))
+            return
+        if bbox is not None or near is not None:
+            if bbox is not None:
+                items = await lst.items.within(_parse_floats(bbox, 4, 'bad_bbox_format'),
+                                               asynchronous=ON)
+            else:
+                coords = _parse_floats(near, 2, 'bad_near_format')
+                radius = _parse_floats(self.get_query_argument('radius', ''), 1,
+                                       'bad_radius_format')[0]
+                items = await lst.items.near(coords, radius, asynchronous=ON)
+            self.app.user = self.current_user
+            self.write(json.dumps([item.json(restricted=True, include=True) for item in items]))
+            return
+
+        # Stream all items batch by batch, so neither the whole list nor the whole response has to
+        # be held in memory. Items are encoded from lightweight views, without materializing them.
+        self.set_header('Content-Type', 'application/json; charset=UTF-8')
+        self.write('[')
+        separator = ''
+        batches = lst.items.view_batches(trashed=trashed)
+        while True:
+            # Fetch each batch in a thread, so that the event loop is not blocked meanwhile
+            items = await self.app.call_in_thread(next, batches, None)
+            if items is None:
+                break
+            self.app.user = self.current_user
+            self.write(separator + ','.join(i.encoded_json(True, True) for i in items))
+            separator = ','
+            await self.flush()
+        self.write(']')
 
     async def post(self, id):
         lst = self.app.lists[id]
@@ -139,10 +411,34 @@ class _ListItemsEndpoint(Endpoint):
         item = await lst.items.create(asynchronous=ON, **args)
         self.write(item.json(restricted=True, include=True))
 
+class _ListItemsBatchEndpoint(Endpoint):
+    async def post(self, id):
+        lst = self.app.lists[id]
+        args = self.check_args({'ops': list})
+        for op in args['ops']:
+            _check_op(op, 'bad_ops_type')
+            if op.get('location') is not None:
+                try:
+                    op['location'] = Location.parse(op['location'])
+                except TypeError:
+                    raise micro.ValueError('bad_location_type')
+        items = await lst.items.batch(**args)
+        self.write(json.dumps([item.json(restricted=True, include=True) for item in items]))
+
+class _ListItemsSearchEndpoint(Endpoint):
+    async def get(self, id):
+        lst = await self.app.lists.fetch(id)
+        items = await lst.items.search(self.get_query_argument('q'), asynchronous=ON)
+        self.app.user = self.current_user
+        self.write(json.dumps([item.json(restricted=True, include=True) for item in items]))
+
 class _ItemEndpoint(Endpoint):
     def get(self, list_id, id):
+        if _check_not_modified(self, list_id):
+            return
         item = self.app.lists[list_id].items[id]
-        self.write(item.json(restricted=True, include=True))
+        self.set_header('Content-Type', 'application/json; charset=UTF-8')
+        self.write(item.encoded_json(restricted=True, include=True))
 
     async def post(self, list_id, id):
         item = self.app.lists[list_id].items[id]
@@ -172,6 +468,11 @@ class _ItemUncheckEndpoint(Endpoint):
         item.uncheck()
         self.write(item.json(restricted=True, include=True))
 
+class _MetricsEndpoint(Endpoint):
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.write(self.server.export_metrics())
+
 class _ListPage(UI):
     def get_meta(self, *args: str):
         try:
@@ -186,3 +487,54 @@ class _ListPage(UI):
             'og:title': lst.title,
             'og:description': description
         }
+
+def _check_op(op, code, *, create=False):
+    # Check the arguments of the item operation op for their expected type or raise a ValueError
+    # with code. If create is set, op is a create operation without the op argument.
+    if not isinstance(op, dict):
+        raise micro.ValueError(code)
+    if not create:
+        if not isinstance(op.get('op'), str):
+            raise micro.ValueError(code)
+        create = op['op'] == 'create'
+    if create:
+        types = {'title': str, 'text': str, 'resource': str, 'location': dict, 'checked': bool}
+    else:
+        types = {'item_id': str}
+    for name, t in types.items():
+        if not isinstance(op.get(name), (t, type(None))):
+            raise micro.ValueError(code)
+
+def _parse_floats(value, count, code):
+    # Parse a comma separated list of count numbers or raise a ValueError with code
+    try:
+        values = [float(v) for v in value.split(',')]
+    except ValueError:
+        raise micro.ValueError(code)
+    if len(values) != count:
+        raise micro.ValueError(code)
+    return values
+
+def _get_limit(endpoint):
+    # Get the page limit query argument of the endpoint or raise a ValueError
+    try:
+        limit = int(endpoint.get_query_argument('limit', str(LIST_LIMIT)))
+    except ValueError:
+        raise micro.ValueError('bad_limit_format')
+    if not 0 < limit <= LIST_LIMIT:
+        raise micro.ValueError('out_of_range_limit')
+    return limit
+
+def _check_not_modified(endpoint, list_id):
+    # Tag the response with the revision of the list with list_id and answer with Not Modified if
+    # the client already has it. The user is part of the tag, because representations may differ
+    # between users.
+    revision = endpoint.app.lists.revision(list_id)
+    if revision is None:
+        return False
+    user = endpoint.current_user
+    endpoint.set_header('Etag', '"{}-{}"'.format(revision, user.id if user else ''))
+    if endpoint.check_etag_header():
+        endpoint.set_status(http.client.NOT_MODIFIED)
+        return True
+    return False
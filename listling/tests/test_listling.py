@@ -14,10 +14,16 @@
 
 # pylint: disable=missing-docstring; test module
 
+from asyncio import get_event_loop, sleep
+from datetime import timedelta
+import json
 from subprocess import check_call
 from tempfile import mkdtemp
+from threading import Event
 
-from micro.util import ON
+from micro import Location
+from micro.resource import NoResourceError, Resource
+from micro.util import ON, cancel
 from tornado.testing import AsyncTestCase, gen_test
 
 from listling import Listling
@@ -59,6 +65,159 @@ class ListlingTest(ListlingTestCase):
         self.assertTrue(lst.items)
         self.assertIn(lst.id, self.app.lists)
 
+    def test_lists_create_example_sync(self):
+        lst = self.app.lists.create_example('todo')
+        self.assertTrue(lst.items)
+
+    @gen_test
+    async def test_lists_import(self):
+        lst = await self.app.lists.import_(
+            'Cat colony tasks', [{'title': 'Feed cats', 'checked': True}, {'title': 'Clean up'}],
+            use_case='todo')
+        self.assertEqual(lst.title, 'Cat colony tasks')
+        self.assertEqual([(item.title, item.checked) for item in lst.items.values()],
+                         [('Feed cats', True), ('Clean up', False)])
+        self.assertIn(lst.id, self.user.lists)
+
+    @gen_test
+    async def test_lists_import_checked_feature_disabled(self):
+        with self.assertRaisesRegex(ValueError, 'feature_disabled'):
+            await self.app.lists.import_('Cat colony tasks',
+                                         [{'title': 'Feed cats', 'checked': True}])
+        self.assertEqual(len(self.user.lists), 0)
+
+    @gen_test
+    async def test_lists_fetch(self):
+        lst = self.app.lists.create(v=2)
+        self.app.user = self.user
+        fetched = await self.app.lists.fetch(lst.id)
+        self.assertEqual(fetched.id, lst.id)
+        self.assertIs(self.app.lists[lst.id], fetched)
+        with self.assertRaises(KeyError):
+            await self.app.lists.fetch('foo')
+
+    @gen_test
+    async def test_analyzer_analyze_cached(self):
+        self.app.r.set('resource_cache:https://example.org/',
+                       json.dumps(Resource('https://example.org/', 'text/html').json()))
+        self.app.r.set('resource_cache:https://example.org/foo',
+                       json.dumps({'error': 'NoResourceError', 'message': 'No resource'}))
+        resource = await self.app.analyzer.analyze('https://example.org/')
+        self.assertEqual(resource.content_type, 'text/html')
+        with self.assertRaises(NoResourceError):
+            await self.app.analyzer.analyze('https://example.org/foo')
+
+    @gen_test
+    async def test_start_jobs(self):
+        lst = self.app.lists.create(v=2)
+        lst.activity.subscribe()
+        self.app.login()
+        await lst.items.create('Sleep', asynchronous=ON)
+        self.assertEqual(self.app.r.zcard('jobs'), 1)
+
+        task = self.app.start_jobs(workers=1)
+        while self.app.r.zcard('jobs'):
+            await sleep(0.1)
+        await cancel(task)
+
+    def test_transaction(self):
+        with self.app.transaction():
+            lst = self.app.lists.create(v=2)
+            self.assertNotIn(lst.id, self.app.lists)
+        self.assertIn(lst.id, self.app.lists)
+        self.assertEqual(lst.revision, 1)
+
+    def test_transaction_error(self):
+        with self.assertRaises(KeyError):
+            with self.app.transaction():
+                lst = self.app.lists.create(v=2)
+                raise KeyError()
+        self.assertNotIn(lst.id, self.app.lists)
+
+    @gen_test
+    async def test_transaction_error_effects(self):
+        lst = self.app.lists.create('todo', v=2)
+        item = lst.items.create('Sleep')
+        trashed_item = lst.items.create('Eat')
+        stream = lst.activity.stream()
+        with self.assertRaises(KeyError):
+            with self.app.transaction():
+                item.edit(title='Nap')
+                item.check()
+                trashed_item.trash()
+                raise KeyError()
+        self.assertIsNone(self.app.r.r.zscore('micro_trash', trashed_item.id))
+
+        item.uncheck()
+        event = await stream.__anext__()
+        await stream.aclose()
+        self.app.r.uncache(item.id)
+        self.assertEqual(event.type, 'item-uncheck')
+        self.assertEqual(self.app.r.oget(item.id).title, 'Nap')
+
+    @gen_test
+    async def test_purge_trash(self):
+        lst = await self.app.lists.create_example('todo', asynchronous=ON)
+        first, second, _ = lst.items.values()
+        first.trash()
+        self.assertEqual(self.app.purge_trash(), 0)
+        self.app.trash_retention = timedelta()
+        second.trash()
+        self.assertEqual(self.app.purge_trash(), 2)
+        self.assertFalse(self.app.r.exists(first.id))
+        self.assertEqual(list(lst.items.batches(trashed=True)), [])
+        self.assertEqual(len(lst.items), 1)
+
+    @gen_test
+    async def test_transaction_other_thread(self):
+        lst = self.app.lists.create('todo', v=2)
+        item = await lst.items.create('Sleep', asynchronous=ON)
+        started = Event()
+        done = Event()
+        def _transaction():
+            with self.app.transaction():
+                started.set()
+                done.wait()
+        future = get_event_loop().run_in_executor(None, _transaction)
+        started.wait()
+        item.check()
+        checked = self.app.r.r.hget(item.id, 'checked')
+        done.set()
+        await future
+        self.assertEqual(checked, b'true')
+
+    @gen_test
+    async def test_start_empty_trash(self):
+        self.app.trash_retention = timedelta()
+        lst = self.app.lists.create(v=2)
+        item = await lst.items.create('Sleep', asynchronous=ON)
+        item.trash()
+        task = self.app.start_empty_trash()
+        while self.app.r.exists(item.id):
+            await sleep(0.1)
+        await cancel(task)
+
+    @gen_test
+    async def test_share_caches(self):
+        other = Listling(redis_url='15')
+        self.app.share_caches()
+        other.share_caches()
+        lst = self.app.lists.create(v=2)
+        lst.encoded_json(restricted=True, include=True)
+        other.user = other.users[self.user.id]
+        other.lists[lst.id].edit(title='Cat colony tasks')
+        while json.loads(self.app.r.oget(lst.id).encoded_json(restricted=True, include=True))[
+                'title'] != 'Cat colony tasks':
+            await sleep(0.1)
+
+    @gen_test
+    async def test_compact_activities(self):
+        lst = await self.app.lists.create_example('todo', asynchronous=ON)
+        await lst.items.create('Sleep', asynchronous=ON)
+        self.app.activity_max_events = 1
+        self.assertGreater(self.app.compact_activities(), 0)
+        self.assertEqual(len(lst.activity), 1)
+
 class ListlingUpdateTest(AsyncTestCase):
     @staticmethod
     def setup_db(tag):
@@ -81,6 +240,17 @@ class ListlingUpdateTest(AsyncTestCase):
         user = app.settings.staff[0]
         self.assertEqual(set(user.lists.values()), set(app.lists[0:2]))
 
+    def test_update_db_interrupted(self):
+        self.setup_db('0.13.0')
+        app = Listling(redis_url='15')
+        app.r.hset('update_checkpoints', '7-lists', 'done')
+        app.update()
+
+        user = app.settings.staff[0]
+        self.assertEqual(len(user.lists), 0)
+        self.assertEqual(int(app.r.get('version')), 14)
+        self.assertFalse(app.r.exists('update_checkpoints'))
+
     def test_update_db_version_first(self):
         self.setup_db('0.2.1')
         app = Listling(redis_url='15')
@@ -102,6 +272,21 @@ class ListlingUpdateTest(AsyncTestCase):
         # Update to version 7
         user = app.settings.staff[0]
         self.assertEqual(set(user.lists.values()), set(app.lists[0:2]))
+        # Update to version 8
+        self.assertIn(item.id, lst.items)
+        self.assertEqual(lst.items.index(item), 0)
+        # Update to version 9
+        self.assertEqual([i.id for i in lst.items.search(item.title)], [item.id])
+        # Update to version 10
+        self.assertEqual(lst.items.within((-90, -180, 90, 180)), [])
+        # Update to version 11
+        self.assertEqual(lst.summary()['item_count'], len(lst.items))
+        # Update to version 12
+        self.assertEqual(app.r.type(item.id), b'hash')
+        # Update to version 13
+        self.assertFalse(any(i.trashed for i in lst.items.values()))
+        # Update to version 14
+        self.assertEqual(int(app.r.get('{}.sequence'.format(lst.activity.id))), len(lst.activity))
 
 class UserListsTest(ListlingTestCase):
     def test_add(self):
@@ -119,6 +304,34 @@ class UserListsTest(ListlingTestCase):
         user.lists.remove(shared_lst, user=user)
         self.assertEqual(list(user.lists.values()), [lst])
 
+    def test_search(self):
+        lst = self.app.lists.create(v=2)
+        lst.edit(title='Cat colony tasks')
+        self.app.lists.create(v=2).edit(title='Dog tasks')
+        self.assertEqual([l.id for l in self.user.lists.search('TASKS cat')], [lst.id])
+
+    def test_page(self):
+        lists = [self.app.lists.create(v=2) for _ in range(3)]
+        # Lists with the same score are ordered by ID
+        self.app.r.zadd(self.user.lists.ids.key, {lst.id: 0 for lst in lists})
+        lists.sort(key=lambda lst: lst.id)
+        page, cursor = self.user.lists.page(limit=2)
+        new = self.app.lists.create(v=2)
+        rest, end = self.user.lists.page(cursor, limit=2)
+        self.assertEqual([lst.id for lst in page + rest], [lst.id for lst in lists])
+        self.assertIsNone(end)
+        self.assertIn(new.id, self.user.lists)
+
+    def test_json(self):
+        lst = self.app.lists.create(v=2)
+        lst.items.create('Sleep')
+        self.app.lists.create(v=2)
+        obj = self.user.lists.json(restricted=True, include=True, slc=slice(None))
+        self.assertEqual(obj['count'], 2)
+        self.assertEqual(obj['slice'], [0, 2])
+        self.assertEqual([l['item_count'] for l in obj['items']], [0, 1])
+        self.assertEqual(obj['items'], self.user.lists.items_json(self.user.lists[:], True, True))
+
     def test_remove_as_list_owner(self):
         lst = self.app.lists.create(v=2)
         with self.assertRaisesRegex(ValueError, 'owner'):
@@ -144,12 +357,216 @@ class ListTest(ListlingTestCase):
         with self.assertRaises(PermissionError):
             lst.edit(description='What has to be done!')
 
+    def test_encoded_json(self):
+        lst = self.app.lists.create(v=2)
+        lst.encoded_json(restricted=True, include=True)
+        lst.edit(title='Cat colony tasks')
+        self.assertEqual(json.loads(lst.encoded_json(restricted=True, include=True)),
+                         lst.json(restricted=True, include=True))
+
+    def test_encoded_json_user_lists(self):
+        lst = self.app.lists.create(v=2)
+        lst.encoded_json(restricted=True, include=True)
+        self.app.lists.create(v=2)
+        obj = json.loads(lst.encoded_json(restricted=True, include=True))
+        self.assertEqual(obj['authors'][0]['lists']['count'], 2)
+
+    @gen_test
+    async def test_changes(self):
+        lst = await self.app.lists.create_example('todo', asynchronous=ON)
+        first, second, third = lst.items.values()
+        since = lst.revision
+        await second.edit(text='Draft first', asynchronous=ON)
+        lst.items.move(first, third)
+        third.delete()
+        revision, changes = lst.changes(since)
+        self.assertEqual(revision, lst.revision)
+        self.assertEqual([(id, item.title if item else None, after_id)
+                          for id, item, after_id in changes],
+                         [(third.id, None, None), (second.id, 'Create draft', None),
+                          (first.id, 'Do research', second.id)])
+
+    def test_changes_since_out_of_range(self):
+        lst = self.app.lists.create(v=2)
+        with self.assertRaisesRegex(ValueError, 'since_out_of_range'):
+            lst.changes(lst.revision + 1)
+
+    @gen_test
+    async def test_summary(self):
+        lst = await self.app.lists.create_example('todo', asynchronous=ON)
+        first, second, third = lst.items.values()
+        first.check()
+        second.check()
+        second.trash()
+        third.delete()
+        summary = lst.summary()
+        self.assertEqual(summary['item_count'], 1)
+        self.assertEqual(summary['checked_item_count'], 1)
+        self.assertIsNotNone(summary['modify_time'])
+
+    @gen_test
+    async def test_repair_summaries(self):
+        lst = await self.app.lists.create_example('todo', asynchronous=ON)
+        next(iter(lst.items.values())).check()
+        self.app.r.delete('{}.items.present'.format(lst.id), '{}.items.checked'.format(lst.id),
+                          '{}.modify_time'.format(lst.id))
+        self.app.repair_summaries()
+        summary = lst.summary()
+        self.assertEqual(summary['item_count'], 3)
+        self.assertEqual(summary['checked_item_count'], 1)
+        self.assertIsNotNone(summary['modify_time'])
+
+    @gen_test
+    async def test_stream(self):
+        lst = self.app.lists.create(v=2)
+        stream = lst.stream()
+        other = lst.stream()
+        item = await lst.items.create('Sleep', asynchronous=ON)
+        event = await stream.__anext__()
+        await stream.aclose()
+        await other.aclose()
+        self.assertEqual(event.type, 'list-create-item')
+        self.assertEqual(event.detail['item'], item)
+
     @gen_test
     async def test_items_create(self):
         lst = self.app.lists.create(v=2)
         item = await lst.items.create('Sleep', asynchronous=ON)
         self.assertIn(item.id, lst.items)
 
+    @gen_test
+    async def test_items_move(self):
+        lst = await self.app.lists.create_example('todo', asynchronous=ON)
+        first, second, third = lst.items.values()
+        lst.items.move(third, first)
+        lst.items.move(second, third)
+        lst.items.move(first, second)
+        lst.items.move(second, None)
+        self.assertEqual(list(lst.items.values()), [second, third, first])
+
+    @gen_test
+    async def test_items_create_trashed(self):
+        lst = await self.app.lists.create_example('todo', asynchronous=ON)
+        first, second, third = lst.items.values()
+        third.trash()
+        item = await lst.items.create('Sleep', asynchronous=ON)
+        third.restore()
+        self.assertEqual(list(lst.items.values()), [first, second, third, item])
+
+    @gen_test
+    async def test_items_search(self):
+        lst = await self.app.lists.create_example('todo', asynchronous=ON)
+        first, _, third = lst.items.values()
+        await third.edit(text='Summary of the research', asynchronous=ON)
+        self.assertEqual([i.id for i in lst.items.search('research')], [first.id, third.id])
+        first.trash()
+        self.assertEqual([i.id for i in lst.items.search('research')], [third.id])
+
+    @gen_test
+    async def test_items_within(self):
+        lst = self.app.lists.create('map', v=2)
+        berlin = await lst.items.create(
+            'Berlin', location=Location('Berlin', (52.52, 13.405)), asynchronous=ON)
+        await lst.items.create('Paris', location=Location('Paris', (48.857, 2.352)),
+                               asynchronous=ON)
+        fiji = await lst.items.create(
+            'Fiji', location=Location('Fiji', (-17.713, 178.065)), asynchronous=ON)
+        auckland = await lst.items.create(
+            'Auckland', location=Location('Auckland', (-36.848, 174.763)), asynchronous=ON)
+        self.assertEqual([i.id for i in lst.items.within((50, 10, 55, 15))], [berlin.id])
+        self.assertEqual([i.id for i in lst.items.within((-40, 170, -10, -170))],
+                         [fiji.id, auckland.id])
+
+    @gen_test
+    async def test_items_near(self):
+        lst = self.app.lists.create('map', v=2)
+        berlin = await lst.items.create(
+            'Berlin', location=Location('Berlin', (52.52, 13.405)), asynchronous=ON)
+        potsdam = await lst.items.create(
+            'Potsdam', location=Location('Potsdam', (52.39, 13.065)), asynchronous=ON)
+        paris = await lst.items.create(
+            'Paris', location=Location('Paris', (48.857, 2.352)), asynchronous=ON)
+        paris.trash()
+        self.assertEqual([i.id for i in lst.items.near((52.4, 13.1), 50000)],
+                         [potsdam.id, berlin.id])
+
+    @gen_test
+    async def test_items_batch(self):
+        lst = await self.app.lists.create_example('todo', asynchronous=ON)
+        first, second, _ = lst.items.values()
+        items = await lst.items.batch([
+            {'op': 'uncheck', 'item_id': first.id},
+            {'op': 'check', 'item_id': second.id},
+            {'op': 'trash', 'item_id': second.id},
+            {'op': 'create', 'title': 'Celebrate'}
+        ])
+        self.assertEqual([item.id for item in items[:3]], [first.id, second.id, second.id])
+        self.assertFalse(items[0].checked)
+        self.assertTrue(items[1].checked)
+        self.assertTrue(items[2].trashed)
+        self.assertEqual(items[3].title, 'Celebrate')
+        self.assertIn(items[3].id, lst.items)
+        self.assertEqual(lst.activity[0].type, 'list-items-batch')
+
+    @gen_test
+    async def test_items_batch_empty_as_user(self):
+        lst = self.app.lists.create('todo', v=2)
+        lst.edit(mode='view')
+        self.app.login()
+        with self.assertRaisesRegex(ValueError, 'ops_empty'):
+            await lst.items.batch([])
+
+    @gen_test
+    async def test_items_batch_item_not_found(self):
+        lst = self.app.lists.create('todo', v=2)
+        with self.assertRaisesRegex(ValueError, 'item_not_found'):
+            await lst.items.batch([{'op': 'check', 'item_id': 'foo'}])
+
+    @gen_test
+    async def test_items_batches(self):
+        lst = await self.app.lists.create_example('todo', asynchronous=ON)
+        batches = list(lst.items.batches(size=2))
+        self.assertEqual([len(items) for items in batches], [2, 1])
+        self.assertEqual([item.id for items in batches for item in items], list(lst.items))
+
+    @gen_test
+    async def test_items_view_batches(self):
+        lst = await self.app.lists.create_example('todo', asynchronous=ON)
+        lst.items[0].check()
+        batches = list(lst.items.view_batches(size=2))
+        views = [view for views in batches for view in views]
+        self.assertEqual([len(views) for views in batches], [2, 1])
+        self.assertEqual([view.id for view in views], list(lst.items))
+        self.assertEqual(views[0].title, lst.items[0].title)
+        self.assertTrue(views[0].checked)
+        self.assertEqual(json.loads(views[0].encoded_json(True, True)),
+                         lst.items[0].json(True, True))
+
+class ActivityTest(ListlingTestCase):
+    @gen_test
+    async def test_publish_max_events(self):
+        self.app.activity_max_events = 2
+        lst = self.app.lists.create('todo', v=2)
+        first = await lst.items.create('Sleep', asynchronous=ON)
+        await lst.items.create('Feed cats', asynchronous=ON)
+        first.check()
+        self.assertEqual([event.type for event in lst.activity[:]],
+                         ['item-check', 'list-create-item'])
+
+    @gen_test
+    async def test_page(self):
+        lst = await self.app.lists.create_example('todo', asynchronous=ON)
+        first, second, third = lst.items.values()
+        first.check()
+        second.check()
+        events = lst.activity[:]
+        page, cursor = lst.activity.page(limit=2)
+        # Publish an event between pages
+        third.check()
+        next_page, next_cursor = lst.activity.page(cursor, limit=len(events))
+        self.assertEqual([event.id for event in page + next_page], [event.id for event in events])
+        self.assertIsNone(next_cursor)
+
 class ItemTest(ListlingTestCase):
     def make_item(self, *, use_case='simple', mode=None):
         lst = self.app.lists.create(use_case, v=2)
@@ -163,11 +580,55 @@ class ItemTest(ListlingTestCase):
         await item.edit(text='Very important!', asynchronous=ON)
         self.assertEqual(item.text, 'Very important!')
 
+    def test_list(self):
+        item = self.make_item()
+        lst = item.list
+        self.assertIs(item.list, lst)
+        self.assertIs(self.app.lists[lst.id], lst)
+
+    def test_delete(self):
+        item = self.make_item()
+        lst = item.list
+        item.delete()
+        self.assertNotIn(item.id, lst.items)
+        self.assertEqual(len(lst.items), 0)
+
+    def test_trash(self):
+        item = self.make_item()
+        lst = item.list
+        item.trash()
+        self.assertNotIn(item.id, lst.items)
+        self.assertEqual(lst.items[item.id], item)
+        self.assertEqual([i.id for items in lst.items.batches(trashed=True) for i in items],
+                         [item.id])
+
+    def test_restore(self):
+        item = self.make_item()
+        lst = item.list
+        item.trash()
+        item.restore()
+        self.assertEqual(list(lst.items.values()), [item])
+        self.assertEqual(list(lst.items.batches(trashed=True)), [])
+
+    def test_encoded_json(self):
+        item = self.make_item(use_case='todo')
+        item.encoded_json(restricted=True, include=True)
+        item.check()
+        self.assertEqual(json.loads(item.encoded_json(restricted=True, include=True)),
+                         item.json(restricted=True, include=True))
+
     def test_check(self):
         item = self.make_item(use_case='todo')
         item.check()
         self.assertTrue(item.checked)
 
+    def test_check_concurrent_edit(self):
+        item = self.make_item(use_case='todo')
+        self.app.r.hset(item.id, 'title', json.dumps('Nap'))
+        item.check()
+        self.assertEqual(json.loads(self.app.r.hget(item.id, 'title').decode()), 'Nap')
+        self.assertTrue(json.loads(self.app.r.hget(item.id, 'checked').decode()))
+
     def test_check_feature_disabled(self):
         item = self.make_item()
         with self.assertRaisesRegex(ValueError, 'feature_disabled'):
@@ -17,8 +17,10 @@
 import json
 
 from micro.test import ServerTestCase
+from micro.util import ON
 from tornado.testing import gen_test
 
+from listling.benchmark import Benchmark
 from listling.server import make_server
 
 class ServerTest(ServerTestCase):
@@ -39,6 +41,8 @@ class ServerTest(ServerTestCase):
 
         # API
         await self.request('/api/users/{}/lists'.format(self.client_user.id))
+        await self.request('/api/users/{}/lists?cursor='.format(self.client_user.id))
+        await self.request('/api/users/{}/lists/search?q=tasks'.format(self.client_user.id))
         await self.request('/api/users/{}/lists'.format(self.client_user.id), method='POST',
                            body=json.dumps({'list_id': shared_lst.id}))
         await self.request('/api/users/{}/lists/{}'.format(self.client_user.id, shared_lst.id),
@@ -46,12 +50,25 @@ class ServerTest(ServerTestCase):
         await self.request('/api/lists', method='POST', body='{"v": 2}')
         await self.request('/api/lists/create-example', method='POST',
                            body='{"use_case": "shopping"}')
+        await self.request('/api/lists/import', method='POST',
+                           body=json.dumps({'title': 'Cat colony tasks',
+                                            'items': 'title,text\nFeed cats,Twice a day\n'}))
         await self.request('/api/lists/{}'.format(lst.id))
         await self.request('/api/lists/{}'.format(lst.id), method='POST',
                            body='{"description": "What has to be done!"}')
+        await self.request('/api/lists/{}/changes?since=0'.format(lst.id))
+        await self.request('/api/lists/{}/activity/:'.format(lst.id))
+        await self.request('/api/lists/{}/activity?cursor='.format(lst.id))
         await self.request('/api/lists/{}/items'.format(lst.id))
+        await self.request('/api/lists/{}/items?slice=1:'.format(lst.id))
+        await self.request('/api/lists/{}/items?trashed=true'.format(lst.id))
         await self.request('/api/lists/{}/items'.format(lst.id), method='POST',
                            body='{"title": "Sleep"}')
+        await self.request('/api/lists/{}/items/batch'.format(lst.id), method='POST',
+                           body=json.dumps({'ops': [{'op': 'check', 'item_id': item.id}]}))
+        await self.request('/api/lists/{}/items?bbox=50,10,55,15'.format(lst.id))
+        await self.request('/api/lists/{}/items?near=52.52,13.405&radius=1000'.format(lst.id))
+        await self.request('/api/lists/{}/items/search?q=research'.format(lst.id))
         await self.request('/api/lists/{}/items/{}'.format(lst.id, item.id))
         await self.request('/api/lists/{}/items/{}'.format(lst.id, item.id), method='POST',
                            body='{"text": "Very important!"}')
@@ -60,5 +77,66 @@ class ServerTest(ServerTestCase):
         await self.request('/api/lists/{}/items/{}/uncheck'.format(lst.id, item.id), method='POST',
                            body='')
 
+        await self.request('/metrics')
+
         # UI
         await self.request('/lists/{}'.format(lst.id))
+
+    @gen_test
+    async def test_post_list_items_batch_bad_ops_type(self):
+        lst = self.app.lists.create('todo', v=2)
+        response = await self.request(
+            '/api/lists/{}/items/batch'.format(lst.id), method='POST',
+            body=json.dumps({'ops': [{'op': 'create', 'title': 5}]}), raise_error=False)
+        self.assertEqual(response.code, 400)
+
+    @gen_test
+    async def test_get_list_items_trashed_slice(self):
+        lst = self.app.lists.create('todo', v=2)
+        response = await self.request(
+            '/api/lists/{}/items?trashed=true&slice=0:10'.format(lst.id), raise_error=False)
+        self.assertEqual(response.code, 400)
+
+    @gen_test
+    async def test_get_list_not_modified(self):
+        lst = self.app.lists.create_example('todo')
+        response = await self.request('/api/lists/{}'.format(lst.id))
+        etag = response.headers['Etag']
+        response = await self.request('/api/lists/{}'.format(lst.id), raise_error=False,
+                                      headers={'If-None-Match': etag})
+        self.assertEqual(response.code, 304)
+
+        await lst.items.create('Sleep', asynchronous=ON)
+        response = await self.request('/api/lists/{}'.format(lst.id),
+                                      headers={'If-None-Match': etag})
+        self.assertEqual(response.code, 200)
+        self.assertNotEqual(response.headers['Etag'], etag)
+
+    @gen_test
+    async def test_get_metrics(self):
+        lst = self.app.lists.create(v=2)
+        await self.request('/api/lists/{}'.format(lst.id))
+        response = await self.request('/metrics')
+        metrics = response.body.decode()
+        self.assertIn(
+            'listling_request_duration_seconds_count{endpoint="/api/lists/([^/]+)",method="GET"} 1',
+            metrics)
+        self.assertIn('listling_redis_roundtrips_total{endpoint="/api/lists/([^/]+)"', metrics)
+
+    @gen_test
+    async def test_get_metrics_workers(self):
+        lst = self.app.lists.create(v=2)
+        await self.request('/api/lists/{}'.format(lst.id))
+        obj = self.app.metrics.json()
+        metrics = self.app.metrics.export({0: obj, 1: obj})
+        for worker in (0, 1):
+            self.assertIn(
+                'listling_request_duration_seconds_count{{worker="{}",'
+                'endpoint="/api/lists/([^/]+)",method="GET"}} 1'.format(worker), metrics)
+        self.assertEqual(metrics.count('# TYPE listling_request_duration_seconds histogram'), 1)
+
+    @gen_test(timeout=60)
+    async def test_benchmark(self):
+        benchmark = Benchmark(self.server, users=1, sizes=[10], requests=2, concurrency=2)
+        results = await benchmark.run()
+        self.assertEqual(results['GET /api/lists/(id) [10]']['requests'], 2)